@@ -22,7 +22,10 @@ SOFTWARE.
 import dbus
 import dbus.service
 
-from bletools import BleTools
+from bletools import BleTools, export_object
+from instrumentation import Instrumented
+from scheduler import Scheduler
+from service import InvalidArgsException
 
 BLUEZ_SERVICE_NAME = "org.bluez"
 LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
@@ -30,8 +33,14 @@ DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
 DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
 LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
 
+ADVERTISEMENT_ROTATE_INTERVAL = 2000 # ms each batch stays on air
 
-class Advertisement(dbus.service.Object):
+
+class Advertisement(Instrumented, dbus.service.Object):
+    """
+    The property dict is built on first use and kept until a setter, or
+    invalidate_properties() after changing an attribute directly, drops it.
+    """
     PATH_BASE = "/org/bluez/example/advertisement"
 
     def __init__(self, index, advertising_type):
@@ -44,11 +53,18 @@ class Advertisement(dbus.service.Object):
         self.manufacturer_data = None
         self.service_data = None
         self.include_tx_power = None
-        dbus.service.Object.__init__(self, self.bus, self.path)
+        self.properties = None
+        export_object(self, self.bus, self.path)
 
     def get_properties(self):
+        if self.properties is None:
+            self.properties = {LE_ADVERTISEMENT_IFACE: self.build_properties()}
+
+        return self.properties
+
+    def build_properties(self):
         properties = dict()
-        properties["Type"] = self.ad_type
+        properties["Type"] = dbus.String(self.ad_type)
 
         if self.local_name is not None:
             properties["LocalName"] = dbus.String(self.local_name)
@@ -69,10 +85,10 @@ class Advertisement(dbus.service.Object):
         if self.include_tx_power is not None:
             properties["IncludeTxPower"] = dbus.Boolean(self.include_tx_power)
 
-        if self.local_name is not None:
-            properties["LocalName"] = dbus.String(self.local_name)
+        return properties
 
-        return {LE_ADVERTISEMENT_IFACE: properties}
+    def invalidate_properties(self):
+        self.properties = None
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -81,26 +97,33 @@ class Advertisement(dbus.service.Object):
         if not self.service_uuids:
             self.service_uuids = []
         self.service_uuids.append(uuid)
+        self.invalidate_properties()
 
     def add_solicit_uuid(self, uuid):
         if not self.solicit_uuids:
             self.solicit_uuids = []
         self.solicit_uuids.append(uuid)
+        self.invalidate_properties()
 
     def add_manufacturer_data(self, manuf_code, data):
         if not self.manufacturer_data:
             self.manufacturer_data = dbus.Dictionary({}, signature="qv")
         self.manufacturer_data[manuf_code] = dbus.Array(data, signature="y")
+        self.invalidate_properties()
 
     def add_service_data(self, uuid, data):
         if not self.service_data:
             self.service_data = dbus.Dictionary({}, signature="sv")
         self.service_data[uuid] = dbus.Array(data, signature="y")
+        self.invalidate_properties()
 
     def add_local_name(self, name):
-        if not self.local_name:
-            self.local_name = ""
         self.local_name = dbus.String(name)
+        self.invalidate_properties()
+
+    def set_include_tx_power(self, include):
+        self.include_tx_power = include
+        self.invalidate_properties()
 
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature="s",
@@ -134,3 +157,124 @@ class Advertisement(dbus.service.Object):
         ad_manager.RegisterAdvertisement(self.get_path(), {},
                                      reply_handler=self.register_ad_callback,
                                      error_handler=self.register_ad_error_callback)
+
+
+class AdvertisementManager(object):
+    """
+    Keeps a set of advertisements on air within the controller's slots.
+
+    start() reads SupportedInstances from the adapter and registers as many
+    advertisements as there are free slots. When there are more than that,
+    every rotate_interval ms each slot unregisters its advertisement and
+    registers the next waiting one, so all of them are seen in turn. A
+    NotPermitted reply means the controller has fewer slots than it said;
+    the advertisement goes back in the queue and the slot is given up.
+    At least one slot is always kept, since slots held by other processes
+    come free again, and each rotation retries it.
+    """
+
+    def __init__(self, bus=None, rotate_interval=ADVERTISEMENT_ROTATE_INTERVAL):
+        self.bus = bus or BleTools.get_bus()
+        self.rotate_interval = rotate_interval
+        self.ad_manager = None
+        self.slots = 0
+        self.active = []
+        self.waiting = []
+        self.releasing = 0
+        self.running = False
+        self.rotate_job = None
+
+    def add(self, advertisement):
+        self.waiting.append(advertisement)
+        self.fill()
+
+    def remove(self, advertisement):
+        if advertisement in self.waiting:
+            self.waiting.remove(advertisement)
+        elif advertisement in self.active:
+            self.active.remove(advertisement)
+            self.unregister(advertisement)
+
+    def start(self):
+        adapter = BleTools.find_adapter(self.bus)
+        adapter_object = self.bus.get_object(BLUEZ_SERVICE_NAME, adapter)
+        self.ad_manager = dbus.Interface(adapter_object, LE_ADVERTISING_MANAGER_IFACE)
+
+        try:
+            self.slots = max(1, int(dbus.Interface(adapter_object, DBUS_PROP_IFACE).Get(
+                    LE_ADVERTISING_MANAGER_IFACE, "SupportedInstances")))
+        except dbus.exceptions.DBusException:
+            # Older BlueZ, learn the limit from NotPermitted replies instead
+            self.slots = len(self.waiting)
+
+        self.running = True
+        self.fill()
+
+    def stop(self):
+        self.running = False
+        if self.rotate_job is not None:
+            self.rotate_job.cancel()
+            self.rotate_job = None
+
+        active, self.active = self.active, []
+        self.waiting = active + self.waiting
+        for advertisement in active:
+            self.unregister(advertisement)
+
+    def fill(self):
+        """Register waiting advertisements into free slots"""
+        # Slots still being released count as taken until BlueZ replies
+        while self.running and self.waiting and len(self.active) + self.releasing < self.slots:
+            self.register(self.waiting.pop(0))
+
+        self.update_rotation()
+
+    def update_rotation(self):
+        rotating = self.running and bool(self.waiting) and self.slots > 0
+        if rotating and self.rotate_job is None:
+            self.rotate_job = Scheduler.get_default().call_every(self.rotate_interval, self.rotate)
+        elif not rotating and self.rotate_job is not None:
+            self.rotate_job.cancel()
+            self.rotate_job = None
+
+    def register(self, advertisement):
+        self.active.append(advertisement)
+        self.ad_manager.RegisterAdvertisement(
+                advertisement.get_path(), {},
+                reply_handler=advertisement.register_ad_callback,
+                error_handler=lambda error: self.on_register_error(advertisement, error))
+
+    def unregister(self, advertisement):
+        self.releasing += 1
+        self.ad_manager.UnregisterAdvertisement(
+                advertisement.get_path(),
+                reply_handler=self.on_unregistered, error_handler=self.on_unregister_error)
+
+    def rotate(self):
+        # Each slot takes the next advertisement once its old one is off air
+        for advertisement in self.active[:len(self.waiting)]:
+            self.active.remove(advertisement)
+            self.waiting.append(advertisement)
+            self.unregister(advertisement)
+
+        # Retries a slot that had nothing on air
+        self.fill()
+
+    def on_unregistered(self):
+        self.releasing -= 1
+        self.fill()
+
+    def on_register_error(self, advertisement, error):
+        if advertisement in self.active:
+            self.active.remove(advertisement)
+        self.waiting.append(advertisement)
+
+        if error.get_dbus_name() == "org.bluez.Error.NotPermitted":
+            self.slots = max(1, len(self.active) + self.releasing)
+            self.update_rotation()
+        else:
+            advertisement.register_ad_error_callback()
+
+    def on_unregister_error(self, error):
+        # The slot is most likely free anyway
+        self.on_unregistered()
@@ -0,0 +1,360 @@
+"""asyncio D-Bus backend for the GATT model, built on dbus-next.
+
+The Application, Service, Characteristic, Descriptor and Advertisement
+classes stay the model. With BleTools.set_backend("asyncio") they are
+created unexported, and AsyncioBackend serves them from a dbus-next
+connection on an asyncio loop instead of dbus-python on GLib:
+
+    loop = asyncio.new_event_loop()
+    Scheduler.set_default(Scheduler(timers=AsyncioTimers(loop)))
+    module = VirtualModule(0)
+    backend = AsyncioBackend("system")
+    loop.run_until_complete(backend.connect())
+    loop.run_until_complete(backend.register_application(module.app))
+
+Every D-Bus call is dispatched as its own task. A handler that is a
+coroutine (async def ReadValue...) can await without holding up the rest
+of the bus, but a plain handler, which every handler in test_module.py is,
+runs to completion on the loop thread like it would on GLib. Handlers must
+stay short either way. Properties, GetManagedObjects and
+InterfacesAdded/Removed are served by dbus-next from the model's property
+dicts. dbus-python is still imported for the model's value types.
+
+The application's com.lmhealth.Debug1 methods are exported at its path,
+and ConnectionTracker follows BlueZ devices through TrackerBus, so
+GetCentrals and disconnect handling work as they do on GLib.
+
+AcquireNotify and AcquireWrite are only served on dbus-python. Their
+NotifyAcquired and WriteAcquired properties are left out here, so BlueZ
+uses StartNotify and WriteValue for those characteristics instead.
+"""
+
+import asyncio
+import inspect
+
+import dbus
+import dbus.exceptions
+from dbus_next import BusType, DBusError, Message, MessageType, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.service import ServiceInterface, PropertyAccess, dbus_property, method
+
+from advertisement import Advertisement, LE_ADVERTISEMENT_IFACE, LE_ADVERTISING_MANAGER_IFACE
+from bletools import BLUEZ_SERVICE_NAME, DBUS_OM_IFACE
+from connections import ConnectionTracker
+from service import Service, Characteristic, Descriptor, GATT_MANAGER_IFACE, \
+    GATT_SERVICE_IFACE, GATT_CHRC_IFACE, GATT_DESC_IFACE, DEBUG_IFACE
+
+# dbus-python value types and their signatures, most specific first
+DBUS_TYPES = (
+    (dbus.Boolean, "b"), (dbus.Byte, "y"), (dbus.Int16, "n"), (dbus.UInt16, "q"),
+    (dbus.Int32, "i"), (dbus.UInt32, "u"), (dbus.Int64, "x"), (dbus.UInt64, "t"),
+    (dbus.Double, "d"), (dbus.ObjectPath, "o"), (dbus.Signature, "g"),
+    (bool, "b"), (int, "i"), (float, "d"), (str, "s"), (bytes, "ay"),
+)
+
+# Characteristic properties announcing the Acquire methods
+ACQUIRE_PROPERTIES = ("NotifyAcquired", "WriteAcquired")
+
+def signature_of(value):
+    """D-Bus signature of a dbus-python or plain Python value"""
+    for kind, signature in DBUS_TYPES:
+        if isinstance(value, kind):
+            return signature
+
+    if isinstance(value, dict):
+        return "a{%s}" % (getattr(value, "signature", None) or "sv")
+    if getattr(value, "signature", None):
+        return "a" + value.signature
+    if value:
+        return "a" + signature_of(value[0])
+    return "as"
+
+def convert(value, signature):
+    """dbus-python value to the plain form dbus-next marshals for signature"""
+    if signature == "v":
+        if isinstance(value, Variant):
+            return value
+        inner = signature_of(value)
+        return Variant(inner, convert(value, inner))
+    if signature == "ay":
+        return bytes(value)
+    if signature.startswith("a{"):
+        key, inner = signature[2], signature[3:-1]
+        return {convert(k, key): convert(v, inner) for k, v in value.items()}
+    if signature.startswith("a"):
+        return [convert(item, signature[1:]) for item in value]
+    if signature in "ynqiuxt":
+        return int(value)
+    if signature == "b":
+        return bool(value)
+    if signature == "d":
+        return float(value)
+    return str(value)
+
+def plain(value):
+    """dbus-next arguments to plain Python values for the model handlers"""
+    if isinstance(value, Variant):
+        return plain(value.value)
+    if isinstance(value, dict):
+        return {k: plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+async def call(handler, *args):
+    """Run a model handler, awaiting it if it is a coroutine"""
+    try:
+        result = handler(*args)
+        if inspect.isawaitable(result):
+            result = await result
+    except dbus.exceptions.DBusException as e:
+        raise DBusError(e.get_dbus_name() or "org.bluez.Error.Failed", e.get_dbus_message() or "")
+    return result
+
+
+class ModelInterface(ServiceInterface):
+    """One D-Bus interface of a model object, properties read from the model"""
+
+    def __init__(self, name, obj):
+        super().__init__(name)
+        self.obj = obj
+
+    def read_property(self, name, signature):
+        return convert(self.obj.get_properties()[self.name][name], signature)
+
+class ServiceModelInterface(ModelInterface):
+    pass
+
+class CharacteristicModelInterface(ModelInterface):
+    def read_value(self):
+        return bytes(self.obj.get_value() or b"")
+
+    @method()
+    async def ReadValue(self, options: "a{sv}") -> "ay":
+        return bytes(await call(self.obj.ReadValue, plain(options)))
+
+    @method()
+    async def WriteValue(self, value: "ay", options: "a{sv}"):
+        await call(self.obj.WriteValue, value, plain(options))
+
+    @method()
+    async def StartNotify(self):
+        await call(self.obj.StartNotify)
+
+    @method()
+    async def StopNotify(self):
+        await call(self.obj.StopNotify)
+
+class DescriptorModelInterface(ModelInterface):
+    @method()
+    async def ReadValue(self, options: "a{sv}") -> "ay":
+        return bytes(await call(self.obj.ReadValue, plain(options)))
+
+    @method()
+    async def WriteValue(self, value: "ay", options: "a{sv}"):
+        await call(self.obj.WriteValue, value, plain(options))
+
+class DebugModelInterface(ModelInterface):
+    """The Application's debug methods, see service.py"""
+
+    @method()
+    def GetStats(self) -> "s":
+        return self.obj.GetStats()
+
+    @method()
+    def GetSlowCalls(self) -> "s":
+        return self.obj.GetSlowCalls()
+
+    @method()
+    def GetCentrals(self) -> "s":
+        return self.obj.GetCentrals()
+
+    @method()
+    def SetInstrumentation(self, enabled: "b", slow_call_ms: "d"):
+        self.obj.SetInstrumentation(enabled, slow_call_ms)
+
+    @method()
+    def ResetStats(self):
+        self.obj.ResetStats()
+
+class AdvertisementModelInterface(ModelInterface):
+    @method()
+    async def Release(self):
+        await call(self.obj.Release)
+
+MODEL_INTERFACES = (
+    (Service, GATT_SERVICE_IFACE, ServiceModelInterface),
+    (Characteristic, GATT_CHRC_IFACE, CharacteristicModelInterface),
+    (Descriptor, GATT_DESC_IFACE, DescriptorModelInterface),
+    (Advertisement, LE_ADVERTISEMENT_IFACE, AdvertisementModelInterface),
+)
+
+def make_property(name, signature, getter=None):
+    def read(self) -> signature:
+        if getter is not None:
+            return getter(self)
+        return self.read_property(name, signature)
+
+    read.__name__ = name
+    return dbus_property(access=PropertyAccess.READ, name=name)(read)
+
+class TrackerBus(object):
+    """
+    The part of the dbus-python bus API ConnectionTracker uses, on a
+    dbus-next connection. Signal and reply arguments arrive as plain values.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.receivers = []
+        bus.add_message_handler(self.on_message)
+
+    def add_signal_receiver(self, handler, dbus_interface, signal_name, bus_name=None,
+                            arg0=None, path_keyword=None):
+        rule = "type='signal',interface='%s',member='%s'" % (dbus_interface, signal_name)
+        if bus_name is not None:
+            rule += ",sender='%s'" % bus_name
+        if arg0 is not None:
+            rule += ",arg0='%s'" % arg0
+        self.receivers.append((handler, dbus_interface, signal_name, arg0, path_keyword))
+        asyncio.ensure_future(self.bus.call(Message(
+            destination="org.freedesktop.DBus", path="/org/freedesktop/DBus",
+            interface="org.freedesktop.DBus", member="AddMatch", signature="s", body=[rule])))
+
+    def on_message(self, message):
+        if message.message_type != MessageType.SIGNAL:
+            return
+
+        for handler, interface, member, arg0, path_keyword in self.receivers:
+            if message.interface != interface or message.member != member:
+                continue
+            if arg0 is not None and (not message.body or message.body[0] != arg0):
+                continue
+
+            kwargs = {path_keyword: message.path} if path_keyword else {}
+            handler(*plain(message.body), **kwargs)
+
+    def call_async(self, bus_name, path, interface, method, signature, args,
+                   reply_handler, error_handler):
+        async def run():
+            reply = await self.bus.call(Message(
+                destination=bus_name, path=path, interface=interface, member=method,
+                signature=signature, body=list(args)))
+            if reply.message_type == MessageType.ERROR:
+                error_handler(DBusError(reply.error_name, reply.body[0] if reply.body else ""))
+            else:
+                reply_handler(*plain(reply.body))
+
+        asyncio.ensure_future(run())
+
+class AsyncioBackend(object):
+    interface_classes = {}
+
+    def __init__(self, address="system"):
+        self.address = address
+        self.bus = None
+        self.interfaces = {}
+
+    async def connect(self):
+        if self.address == "system":
+            bus = MessageBus(bus_type=BusType.SYSTEM)
+        elif self.address == "session":
+            bus = MessageBus(bus_type=BusType.SESSION)
+        else:
+            bus = MessageBus(bus_address=self.address)
+
+        self.bus = await bus.connect()
+
+        # Connections are tracked once per process, see connections.py
+        ConnectionTracker.start(TrackerBus(self.bus))
+        return self.bus
+
+    def interface_class(self, base, properties, extra=()):
+        """ServiceInterface subclass exposing properties with their current signatures"""
+        fields = tuple((name, signature_of(value)) for name, value in sorted(properties.items()))
+        key = (base, fields, extra)
+        cls = self.interface_classes.get(key)
+        if cls is None:
+            namespace = {name: make_property(name, signature) for name, signature in fields}
+            for name, signature, getter in extra:
+                namespace[name] = make_property(name, signature, getter)
+            cls = self.interface_classes[key] = type(base.__name__, (base,), namespace)
+        return cls
+
+    def export(self, obj):
+        for model, name, base in MODEL_INTERFACES:
+            if isinstance(obj, model):
+                break
+        else:
+            raise TypeError("%s has no asyncio interface" % type(obj).__name__)
+
+        properties = obj.get_properties()[name]
+
+        extra = ()
+        if base is CharacteristicModelInterface:
+            # Notifications go out as PropertiesChanged on Value
+            extra = (("Value", "ay", CharacteristicModelInterface.read_value),)
+            properties = dict((prop, value) for prop, value in properties.items()
+                              if prop not in ACQUIRE_PROPERTIES)
+        interface = self.interface_class(base, properties, extra)(name, obj)
+        self.bus.export(obj.path, interface)
+        self.interfaces[obj.path] = interface
+
+        signatures = dict((prop, signature_of(value)) for prop, value in properties.items())
+        signatures["Value"] = "ay"
+        def properties_changed(iface, changed, invalidated):
+            interface.emit_properties_changed(
+                {prop: convert(value, signatures[prop]) for prop, value in changed.items()
+                 if prop in signatures},
+                list(invalidated))
+        obj.PropertiesChanged = properties_changed
+
+    def unexport(self, path):
+        self.interfaces.pop(path, None)
+        self.bus.unexport(path)
+
+    def find_object(self, app, path):
+        for service in app.services:
+            for obj in service.get_objects():
+                if obj.path == path:
+                    return obj
+        return None
+
+    async def call(self, path, interface, member, signature="", body=()):
+        reply = await self.bus.call(Message(
+            destination=BLUEZ_SERVICE_NAME, path=path, interface=interface,
+            member=member, signature=signature, body=list(body)))
+
+        if reply.message_type == MessageType.ERROR:
+            raise DBusError(reply.error_name, reply.body[0] if reply.body else "")
+        return reply.body
+
+    async def find_adapter(self, interface):
+        objects, = await self.call("/", DBUS_OM_IFACE, "GetManagedObjects")
+        for path, interfaces in objects.items():
+            if interface in interfaces:
+                return path
+        return None
+
+    async def register_application(self, app):
+        """Export every object of app and register it with BlueZ"""
+        for service in app.services:
+            for obj in service.get_objects():
+                self.export(obj)
+        self.bus.export(app.path, DebugModelInterface(DEBUG_IFACE, app))
+
+        # Objects added or removed later follow the model's ObjectManager
+        # signals, dbus-next emits the real ones on export and unexport
+        app.InterfacesAdded = lambda path, interfaces: self.export(self.find_object(app, path))
+        app.InterfacesRemoved = lambda path, interfaces: self.unexport(path)
+
+        adapter = await self.find_adapter(GATT_MANAGER_IFACE)
+        app.registered = True
+        await self.call(adapter, GATT_MANAGER_IFACE, "RegisterApplication",
+                        "oa{sv}", [app.path, {}])
+
+    async def register_advertisement(self, advertisement):
+        self.export(advertisement)
+        adapter = await self.find_adapter(LE_ADVERTISING_MANAGER_IFACE)
+        await self.call(adapter, LE_ADVERTISING_MANAGER_IFACE, "RegisterAdvertisement",
+                        "oa{sv}", [advertisement.path, {}])
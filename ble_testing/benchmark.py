@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+"""GATT server benchmarks against the fake BlueZ on a private bus.
+
+Measures startup-to-registered time, ReadValue/WriteValue latency per
+characteristic, PropertiesChanged emission rate and GetManagedObjects cost
+as the tree grows. The peripheral runs on this process's main loop while a
+FakeCentral drives it from a worker thread over its own connection, so every
+number includes real D-Bus marshalling. Results are written as JSON so runs
+can be compared.
+
+    python3 benchmark.py --output bench.json
+"""
+
+import argparse
+import json
+import platform
+import threading
+import time
+
+import dbus
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from bletools import BleTools, DBUS_OM_IFACE
+from fakebluez import FakeCentral, start_private_bus, spawn
+from service import Application
+from test_module import VirtualModule, TherapyService, BatteryLifeCharacteristic, \
+    IntensityCharacteristic, TargetTimeCharacteristic, TimeStampCharacteristic, \
+    UserIdCharacteristic
+
+WRITE_VALUES = {
+    IntensityCharacteristic: 50,
+    TargetTimeCharacteristic: 300,
+    TimeStampCharacteristic: "03-05-2025T00:00:00",
+    UserIdCharacteristic: "bench-user",
+}
+
+def summarise(samples):
+    """Latency summary in ms for a list of durations in seconds"""
+    if not samples:
+        return {"count": 0}
+
+    ordered = sorted(samples)
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 4)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) * 1000 / len(ordered), 4),
+        "p50_ms": percentile(0.50),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 4),
+    }
+
+def time_calls(call, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+class Benchmark(object):
+    def __init__(self, address, iterations, sizes, notify_seconds):
+        self.address = address
+        self.iterations = iterations
+        self.sizes = sizes
+        self.notify_seconds = notify_seconds
+        self.mainloop = BleTools.get_mainloop()
+        self.module = None
+
+    def run_central(self, work):
+        """Run work(central) on a worker thread while the main loop serves"""
+        result = {}
+
+        def worker():
+            central = FakeCentral(self.address)
+            try:
+                result["value"] = work(central)
+            except Exception as e:
+                result["error"] = e
+            finally:
+                central.close()
+                GObject.idle_add(self.mainloop.quit)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        self.mainloop.run()
+        thread.join()
+
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
+
+    def bench_startup(self):
+        start = time.perf_counter()
+        self.module = VirtualModule(0, fleet=True)
+        created = time.perf_counter()
+        registered = {}
+
+        def on_registered():
+            registered["time"] = time.perf_counter()
+            self.mainloop.quit()
+
+        def on_error(error):
+            registered["error"] = error
+            self.mainloop.quit()
+
+        self.module.app.register(reply_handler=on_registered, error_handler=on_error)
+        self.mainloop.run()
+
+        if "error" in registered:
+            raise registered["error"]
+        return {
+            "construct_ms": round((created - start) * 1000, 3),
+            "registered_ms": round((registered["time"] - start) * 1000, 3),
+        }
+
+    def get_characteristics(self):
+        for service in self.module.app.services:
+            for chrc in service.get_characteristics():
+                yield chrc
+
+    def bench_read_write(self):
+        reads = []
+        writes = []
+        for chrc in self.get_characteristics():
+            name = type(chrc).__name__
+            if "read" in chrc.flags:
+                reads.append((name, chrc.get_path()))
+            if type(chrc) in WRITE_VALUES:
+                writes.append((name, chrc.get_path(), bytes(chrc.codec.encode(WRITE_VALUES[type(chrc)]))))
+
+        def work(central):
+            results = {"read": {}, "write": {}}
+            for name, path in reads:
+                samples = time_calls(lambda: central.read(path), self.iterations)
+                results["read"][name] = summarise(samples)
+            for name, path, value in writes:
+                samples = time_calls(lambda: central.write(path, value), self.iterations)
+                results["write"][name] = summarise(samples)
+            return results
+
+        return self.run_central(work)
+
+    def bench_notify(self):
+        battery = next(chrc for chrc in self.get_characteristics()
+                       if isinstance(chrc, BatteryLifeCharacteristic))
+        received = [0]
+        driven = [0]
+        done = threading.Event()
+
+        def drive():
+            # One value change per main loop iteration
+            driven[0] += 1
+            battery.set_value(driven[0] % 100)
+            return not done.is_set()
+
+        def on_notify(value):
+            received[0] += 1
+
+        def work(central):
+            path = battery.get_path()
+            central.start_notify(path, on_notify)
+            GObject.idle_add(drive)
+            start = time.perf_counter()
+            time.sleep(self.notify_seconds)
+            done.set()
+            elapsed = time.perf_counter() - start
+            central.stop_notify(path)
+            return elapsed
+
+        elapsed = self.run_central(work)
+        return {
+            "seconds": round(elapsed, 3),
+            "value_changes": driven[0],
+            "notifications": received[0],
+            "notifications_per_second": round(received[0] / elapsed, 1),
+        }
+
+    def bench_managed_objects(self):
+        results = []
+        name = BleTools.get_bus().get_unique_name()
+        entry = next(service for service in self.module.table.services
+                     if service.model == "therapy")
+
+        for size in self.sizes:
+            path = "/bench%d" % size
+            app = Application(path)
+            for index in range(size):
+                app.add_service(TherapyService(index, self.module, entry,
+                                               path_base=path + "/service"))
+
+            objects = len(app.GetManagedObjects())
+            local = time_calls(app.GetManagedObjects, self.iterations)
+
+            def work(central):
+                manager = dbus.Interface(central.bus.get_object(name, path, introspect=False),
+                                         DBUS_OM_IFACE)
+                return time_calls(manager.GetManagedObjects, self.iterations)
+
+            remote = self.run_central(work)
+            results.append({
+                "services": size,
+                "objects": objects,
+                "in_process": summarise(local),
+                "over_dbus": summarise(remote),
+            })
+
+        return results
+
+    def run(self):
+        results = {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "iterations": self.iterations,
+        }
+        results["startup"] = self.bench_startup()
+        results.update(self.bench_read_write())
+        results["notify"] = self.bench_notify()
+        results["managed_objects"] = self.bench_managed_objects()
+        return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the virtual module GATT server")
+    parser.add_argument("--output", default="benchmark.json", help="JSON results file")
+    parser.add_argument("--iterations", type=int, default=200, help="calls per measurement")
+    parser.add_argument("--sizes", default="1,10,50",
+                        help="comma separated service counts for GetManagedObjects")
+    parser.add_argument("--notify-seconds", type=float, default=2.0,
+                        help="duration of the notification rate run")
+    args = parser.parse_args()
+
+    daemon, address = start_private_bus()
+    fake = None
+    try:
+        fake = spawn(address)
+        BleTools.set_bus_address(address)
+
+        sizes = [int(size) for size in args.sizes.split(",")]
+        results = Benchmark(address, args.iterations, sizes, args.notify_seconds).run()
+    finally:
+        if fake is not None:
+            fake.terminate()
+        daemon.terminate()
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
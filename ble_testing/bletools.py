@@ -19,39 +19,166 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import os
 import dbus
+import dbus.bus
+import dbus.mainloop.glib
+import dbus.service
 try:
   from gi.repository import GObject
 except ImportError:
     import gobject as GObject
 
 BLUEZ_SERVICE_NAME = "org.bluez"
+ADAPTER_IFACE = "org.bluez.Adapter1"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
 LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
 DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+
+class AdapterRegistry(object):
+    """Tracks BlueZ adapters by interface from one object dump plus signals"""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.objects = {}
+        self.by_interface = {}
+
+        # Subscribe before dumping so nothing is missed in between
+        self.bus.add_signal_receiver(
+            self.on_interfaces_added,
+            dbus_interface=DBUS_OM_IFACE,
+            signal_name="InterfacesAdded",
+            bus_name=BLUEZ_SERVICE_NAME
+        )
+        self.bus.add_signal_receiver(
+            self.on_interfaces_removed,
+            dbus_interface=DBUS_OM_IFACE,
+            signal_name="InterfacesRemoved",
+            bus_name=BLUEZ_SERVICE_NAME
+        )
+
+        remote_om = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, "/"),
+                               DBUS_OM_IFACE)
+        for path, interfaces in remote_om.GetManagedObjects().items():
+            self.on_interfaces_added(path, interfaces)
+
+    def on_interfaces_added(self, path, interfaces):
+        # Only adapters matter here, devices and GATT objects are skipped
+        if ADAPTER_IFACE not in interfaces and path not in self.objects:
+            return
+
+        known = self.objects.setdefault(path, set())
+        for interface in interfaces:
+            known.add(interface)
+            self.by_interface.setdefault(interface, {})[path] = True
+
+    def on_interfaces_removed(self, path, interfaces):
+        known = self.objects.get(path)
+        if known is None:
+            return
+
+        for interface in interfaces:
+            known.discard(interface)
+            self.by_interface.get(interface, {}).pop(path, None)
+
+        if not known:
+            del self.objects[path]
+
+    def find(self, interface):
+        """Path of the first adapter exposing interface, or None"""
+        adapters = self.by_interface.get(interface)
+        if not adapters:
+            return None
+
+        return next(iter(adapters))
+
+    def get_adapters(self, interface=ADAPTER_IFACE):
+        return list(self.by_interface.get(interface, {}))
+
+def export_object(obj, bus, path):
+    """Initialise a dbus.service.Object, exported on bus unless bus is None
+
+    Model objects built for another backend (see aiobackend.py) stay
+    unexported here and are served by that backend instead.
+    """
+    dbus.service.Object.__init__(obj, bus, path if bus is not None else None)
 
 class BleTools(object):
+    bus = None
+    mainloop = None
+    registry = None
+
+    # "glib" serves objects with dbus-python on a GLib main loop, "asyncio"
+    # leaves them to aiobackend.py. BLE_BACKEND in the environment sets it.
+    backend = os.environ.get("BLE_BACKEND", "glib")
+
+    # "system", "session" or a D-Bus address such as a private daemon
+    # running fakebluez.py. BLE_BUS in the environment sets the default.
+    bus_address = os.environ.get("BLE_BUS", "system")
+
+    @classmethod
+    def set_bus_address(self, address):
+        if self.bus is not None:
+            raise RuntimeError("bus already connected")
+        self.bus_address = address
+
+    @classmethod
+    def set_backend(self, backend):
+        if self.bus is not None:
+            raise RuntimeError("bus already connected")
+        self.backend = backend
+
+    @classmethod
+    def connect(self, address):
+        """Open a new connection to address, using the GLib main loop"""
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+        if address == "system":
+            return dbus.SystemBus(private=True)
+        if address == "session":
+            return dbus.SessionBus(private=True)
+        return dbus.bus.BusConnection(address)
+
     @classmethod
     def get_bus(self):
-         bus = dbus.SystemBus()
+        # Every application, service and advertisement in the process shares
+        # one connection, so a fleet of modules costs a single bus client.
+        # Other backends bring their own connection.
+        if self.backend != "glib":
+            return None
+
+        if self.bus is None:
+            self.bus = self.connect(self.bus_address)
 
-         return bus
+        return self.bus
 
     @classmethod
-    def find_adapter(self, bus):
-        remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/"),
-                               DBUS_OM_IFACE)
-        objects = remote_om.GetManagedObjects()
+    def get_mainloop(self):
+        if self.mainloop is None:
+            self.mainloop = GObject.MainLoop()
 
-        for o, props in objects.items():
-            if LE_ADVERTISING_MANAGER_IFACE in props:
-                return o
+        return self.mainloop
 
-        return None
+    @classmethod
+    def get_registry(self, bus=None):
+        if self.registry is None:
+            self.registry = AdapterRegistry(bus or self.get_bus())
+
+        return self.registry
+
+    @classmethod
+    def find_adapter(self, bus, interface=LE_ADVERTISING_MANAGER_IFACE):
+        return self.get_registry(bus).find(interface)
 
     @classmethod
-    def power_adapter(self):
-        adapter = self.get_adapter()
+    def power_adapter(self, bus=None, adapter=None):
+        bus = bus or self.get_bus()
+        adapter = adapter or self.get_registry(bus).find(ADAPTER_IFACE)
+        if adapter is None:
+            return False
 
         adapter_props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
-                "org.freedesktop.DBus.Properties");
-        adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
+                DBUS_PROP_IFACE)
+        adapter_props.Set(ADAPTER_IFACE, "Powered", dbus.Boolean(1))
+        return True
@@ -0,0 +1,87 @@
+"""Injectable time source for the virtual module.
+
+Everything that measures or waits on time (the scheduler, therapy elapsed
+time, battery drain) reads Clock.get_default() instead of the time module,
+so long sessions can run faster than real time:
+
+    RealClock()          wall speed
+    ScaledClock(100)     100 simulated seconds per real second
+    ManualClock()        time only moves on Scheduler.advance()
+
+The clock must be chosen before the first module or scheduler is created.
+"""
+
+import time
+
+
+class Clock(object):
+    default = None
+
+    # Whether the scheduler should arm real main loop timers
+    realtime = True
+
+    @classmethod
+    def get_default(self):
+        if self.default is None:
+            self.default = RealClock()
+
+        return self.default
+
+    @classmethod
+    def set_default(self, clock):
+        self.default = clock
+
+    def now(self):
+        """Simulated seconds on a monotonic scale"""
+        raise NotImplementedError()
+
+    def wall_time(self):
+        """Simulated seconds since the epoch, for timestamps"""
+        return self.epoch + self.now()
+
+    def to_real(self, seconds):
+        """Real seconds to wait for seconds of simulated time to pass"""
+        return seconds
+
+
+class RealClock(Clock):
+    def now(self):
+        return time.monotonic()
+
+    def wall_time(self):
+        return time.time()
+
+
+class ScaledClock(Clock):
+    def __init__(self, factor):
+        if factor <= 0:
+            raise ValueError("Clock scale must be positive")
+
+        self.factor = float(factor)
+        self.origin = time.monotonic()
+        self.epoch = time.time() - self.origin
+
+    def now(self):
+        return self.origin + (time.monotonic() - self.origin) * self.factor
+
+    def to_real(self, seconds):
+        return seconds / self.factor
+
+
+class ManualClock(Clock):
+    realtime = False
+
+    def __init__(self, start=0.0, epoch=None):
+        self.time = float(start)
+        # Wall clock time at now() == 0
+        self.epoch = time.time() - self.time if epoch is None else epoch
+
+    def now(self):
+        return self.time
+
+    def advance(self, seconds):
+        """Move time forward without running anything, see Scheduler.advance"""
+        if seconds < 0:
+            raise ValueError("Time cannot go backwards")
+        self.time += seconds
+
@@ -0,0 +1,120 @@
+"""Typed codecs for characteristic values.
+
+Each value type has an ASCII codec matching the original wire format
+(decimal digits, "0x02" locations, "Active"/"Inactive") and a binary codec
+packing little-endian integers with struct. Strings are UTF-8 in both modes.
+A module picks one mode and every characteristic asks the registry for the
+codec of its value type.
+"""
+
+import struct
+
+ASCII = "ascii"
+BINARY = "binary"
+WIRE_FORMATS = (ASCII, BINARY)
+
+STATUS_NAMES = ("Inactive", "Active")
+
+
+class Codec(object):
+    def encode(self, value):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+
+class StringCodec(Codec):
+    def encode(self, value):
+        return str(value).encode()
+
+    def decode(self, data):
+        return bytes(data).decode()
+
+
+class AsciiIntCodec(Codec):
+    def __init__(self, maximum):
+        self.maximum = maximum
+
+    def encode(self, value):
+        return str(int(value)).encode()
+
+    def decode(self, data):
+        value = int(bytes(data))
+        if value < 0 or value > self.maximum:
+            raise ValueError("%d out of range" % value)
+        return value
+
+
+class AsciiHexCodec(Codec):
+    def encode(self, value):
+        return ("0x%02X" % value).encode()
+
+    def decode(self, data):
+        return int(bytes(data), 16)
+
+
+class AsciiEnumCodec(Codec):
+    def __init__(self, names):
+        self.names = names
+
+    def encode(self, value):
+        return self.names[int(value)].encode()
+
+    def decode(self, data):
+        return self.names.index(bytes(data).decode())
+
+
+class UIntCodec(Codec):
+    def __init__(self, fmt):
+        self.struct = struct.Struct(fmt)
+
+    def encode(self, value):
+        return self.struct.pack(int(value))
+
+    def decode(self, data):
+        data = bytes(data)
+        if len(data) != self.struct.size:
+            raise ValueError("expected %d bytes, got %d" % (self.struct.size, len(data)))
+        return self.struct.unpack(data)[0]
+
+
+class EnumCodec(UIntCodec):
+    def __init__(self, names):
+        UIntCodec.__init__(self, "<B")
+        self.names = names
+
+    def decode(self, data):
+        value = UIntCodec.decode(self, data)
+        if value >= len(self.names):
+            raise ValueError("unknown enum value %d" % value)
+        return value
+
+
+CODECS = {
+    ASCII: {
+        "uint8": AsciiIntCodec(0xFF),
+        "uint16": AsciiIntCodec(0xFFFF),
+        "uint32": AsciiIntCodec(0xFFFFFFFF),
+        "location": AsciiHexCodec(),
+        "status": AsciiEnumCodec(STATUS_NAMES),
+        "string": StringCodec(),
+    },
+    BINARY: {
+        "uint8": UIntCodec("<B"),
+        "uint16": UIntCodec("<H"),
+        "uint32": UIntCodec("<I"),
+        "location": UIntCodec("<B"),
+        "status": EnumCodec(STATUS_NAMES),
+        "string": StringCodec(),
+    },
+}
+
+def register_codec(mode, kind, codec):
+    CODECS.setdefault(mode, {})[kind] = codec
+
+def get_codec(kind, mode=ASCII):
+    try:
+        return CODECS[mode][kind]
+    except KeyError:
+        raise ValueError("no %s codec for %s values" % (mode, kind))
@@ -0,0 +1,236 @@
+"""Registry of the centrals connected to this process.
+
+One tracker per process follows org.bluez Device1 PropertiesChanged and
+InterfacesRemoved signals. A connect creates the central's record straight
+away and its address and name are filled in from an asynchronous GetAll, so
+nothing on the main loop waits on BlueZ however many phones connect at once.
+
+GATT handlers report requests through the class methods below, which do
+nothing until ConnectionTracker.start() has been called:
+
+    ConnectionTracker.request(options, "read")    a ReadValue/WriteValue
+    ConnectionTracker.subscribed(chrc, options)   StartNotify/AcquireNotify
+    ConnectionTracker.unsubscribed(chrc)          StopNotify
+
+BlueZ only passes the calling device in the options of reads, writes and
+Acquire calls. StartNotify carries no device, so it is credited to the
+central when exactly one is connected.
+"""
+
+import collections
+import time
+
+from bletools import BLUEZ_SERVICE_NAME, DBUS_OM_IFACE, DBUS_PROP_IFACE
+from metrics import Metrics
+from scheduler import Scheduler
+
+DEVICE_IFACE = "org.bluez.Device1"
+
+# Disconnected centrals kept for queries
+HISTORY_SIZE = 64
+
+
+class Central(object):
+    def __init__(self, path):
+        self.path = path
+        self.address = None
+        self.name = None
+        self.connected = True
+        self.connect_time = time.time()
+        self.connected_at = Scheduler.get_default().now()
+        self.disconnected_at = None
+        self.last_request = None
+        self.mtu = None
+        self.subscriptions = set()
+        self.requests = collections.Counter()
+
+    def update(self, properties):
+        if "Address" in properties:
+            self.address = str(properties["Address"])
+        if "Name" in properties:
+            self.name = str(properties["Name"])
+
+    def to_dict(self):
+        end = self.disconnected_at if not self.connected else Scheduler.get_default().now()
+        return {
+            "path": self.path,
+            "address": self.address,
+            "name": self.name,
+            "connected": self.connected,
+            "connect_time": round(self.connect_time, 3),
+            "duration_s": round(end - self.connected_at, 3),
+            "mtu": self.mtu,
+            "subscriptions": sorted(self.subscriptions),
+            "requests": dict(self.requests),
+        }
+
+class ConnectionTracker(object):
+    default = None
+
+    # Called with each Central that disconnects
+    listeners = []
+
+    @classmethod
+    def start(self, bus):
+        """Track centrals on bus, once per process"""
+        if self.default is None:
+            self.default = ConnectionTracker(bus)
+
+        return self.default
+
+    @classmethod
+    def watch(self, callback):
+        self.listeners.append(callback)
+
+    @classmethod
+    def request(self, options, kind):
+        tracker = self.default
+        if tracker is None:
+            return
+
+        central = tracker.find(options)
+        if central is not None:
+            central.requests[kind] += 1
+            central.last_request = Scheduler.get_default().now()
+            if "mtu" in options:
+                central.mtu = int(options["mtu"])
+
+    @classmethod
+    def subscribed(self, chrc, options=None):
+        tracker = self.default
+        if tracker is None:
+            return
+
+        central = tracker.find(options or {})
+        if central is None and len(tracker.centrals) == 1:
+            central = next(iter(tracker.centrals.values()))
+        if central is not None:
+            central.subscriptions.add(chrc.path)
+
+    @classmethod
+    def unsubscribed(self, chrc):
+        # BlueZ only stops a characteristic when its last subscriber leaves
+        tracker = self.default
+        if tracker is None:
+            return
+
+        for central in tracker.centrals.values():
+            central.subscriptions.discard(chrc.path)
+
+    @classmethod
+    def snapshot(self):
+        tracker = self.default
+        if tracker is None:
+            return {"connected": [], "recent": [], "connects": 0, "disconnects": 0}
+
+        return {
+            "connected": [central.to_dict() for central in tracker.centrals.values()],
+            "recent": [central.to_dict() for central in tracker.history],
+            "connects": tracker.connects,
+            "disconnects": tracker.disconnects,
+        }
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.centrals = {}
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        self.connects = 0
+        self.disconnects = 0
+
+        # One match rule for every device instead of one receiver per application
+        self.bus.add_signal_receiver(
+            self.on_properties_changed,
+            dbus_interface=DBUS_PROP_IFACE,
+            signal_name="PropertiesChanged",
+            bus_name=BLUEZ_SERVICE_NAME,
+            arg0=DEVICE_IFACE,
+            path_keyword="path"
+        )
+        self.bus.add_signal_receiver(
+            self.on_interfaces_removed,
+            dbus_interface=DBUS_OM_IFACE,
+            signal_name="InterfacesRemoved",
+            bus_name=BLUEZ_SERVICE_NAME
+        )
+
+        # Centrals connected before we started
+        self.call("/", DBUS_OM_IFACE, "GetManagedObjects", "", (),
+                  self.on_objects)
+
+    def call(self, path, interface, method, signature, args, reply_handler):
+        # call_async skips the proxy's blocking name lookup and introspection
+        self.bus.call_async(BLUEZ_SERVICE_NAME, path, interface, method, signature, args,
+                            reply_handler, self.on_error)
+
+    def find(self, options):
+        device = options.get("device")
+        if device is None:
+            return None
+
+        central = self.centrals.get(str(device))
+        if central is None:
+            # A request can beat the Connected signal
+            central = self.connect(str(device))
+        return central
+
+    def connect(self, path, properties=None):
+        central = self.centrals.get(path)
+        if central is not None:
+            return central
+
+        central = self.centrals[path] = Central(path)
+        self.connects += 1
+        if properties:
+            central.update(properties)
+        if central.address is None:
+            self.call(path, DBUS_PROP_IFACE, "GetAll", "s", (DEVICE_IFACE,),
+                      lambda properties: self.on_device_properties(path, properties))
+        else:
+            self.on_identified(central)
+        return central
+
+    def disconnect(self, path):
+        central = self.centrals.pop(path, None)
+        if central is None:
+            return
+
+        central.connected = False
+        central.disconnected_at = Scheduler.get_default().now()
+        self.disconnects += 1
+        self.history.append(central)
+        Metrics.event("central_disconnected", path=path, address=central.address,
+                      duration_s=round(central.disconnected_at - central.connected_at, 3))
+        for listener in list(self.listeners):
+            listener(central)
+
+    def on_identified(self, central):
+        Metrics.event("central_connected", path=central.path, address=central.address)
+
+    def on_objects(self, objects):
+        for path, interfaces in objects.items():
+            properties = interfaces.get(DEVICE_IFACE)
+            if properties is not None and properties.get("Connected"):
+                self.connect(str(path), properties)
+
+    def on_device_properties(self, path, properties):
+        central = self.centrals.get(path)
+        if central is not None:
+            central.update(properties)
+            self.on_identified(central)
+
+    def on_properties_changed(self, interface, changed, invalidated, path):
+        if "Connected" in changed:
+            if changed["Connected"]:
+                self.connect(str(path), changed)
+            else:
+                self.disconnect(str(path))
+        elif str(path) in self.centrals:
+            self.centrals[str(path)].update(changed)
+
+    def on_interfaces_removed(self, path, interfaces):
+        if DEVICE_IFACE in interfaces:
+            self.disconnect(str(path))
+
+    def on_error(self, error):
+        # A device that vanished before its reply came back, nothing to fill in
+        pass
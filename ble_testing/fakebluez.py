@@ -0,0 +1,432 @@
+#!/usr/bin/python3
+"""Local BlueZ stand-in for hardware-free testing.
+
+Runs on a private dbus-daemon and owns org.bluez there, exposing one
+adapter with GattManager1 and LEAdvertisingManager1. Registered GATT
+applications are read back through their ObjectManager, connected centrals
+appear as Device1 objects and FakeCentral drives the registered tree the
+way a phone would through BlueZ.
+
+    python3 fakebluez.py                 # start a private bus and the fake
+    python3 test_module.py --bus <address printed above> --headless
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.bus
+import dbus.exceptions
+import dbus.service
+
+from bletools import BleTools, BLUEZ_SERVICE_NAME, ADAPTER_IFACE, GATT_MANAGER_IFACE, \
+    LE_ADVERTISING_MANAGER_IFACE, DBUS_OM_IFACE, DBUS_PROP_IFACE
+
+DEVICE_IFACE = "org.bluez.Device1"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
+FAKE_IFACE = "org.bluez.test.FakeBluez1"
+
+ADAPTER_PATH = "/org/bluez/hci0"
+ADAPTER_ADDRESS = "00:00:00:00:5A:AD"
+SUPPORTED_ADVERTISEMENTS = 5
+
+class InvalidArgsException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
+
+class AlreadyExistsException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.AlreadyExists"
+
+class DoesNotExistException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.DoesNotExist"
+
+class NotPermittedException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.NotPermitted"
+
+def start_private_bus():
+    """Start a dbus-daemon for this test run, returns (process, address)"""
+    process = subprocess.Popen(
+        ["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    address = process.stdout.readline().strip()
+    if not address:
+        process.kill()
+        raise RuntimeError("dbus-daemon did not report an address")
+
+    return process, address
+
+def spawn(address, timeout=10):
+    """Run the fake in a child process and wait until it owns org.bluez"""
+    process = subprocess.Popen([sys.executable, __file__, "--address", address])
+    bus = dbus.bus.BusConnection(address)
+    deadline = time.monotonic() + timeout
+    try:
+        while not bus.name_has_owner(BLUEZ_SERVICE_NAME):
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("fake BlueZ did not start")
+            time.sleep(0.05)
+    finally:
+        bus.close()
+
+    return process
+
+def device_path(address):
+    return ADAPTER_PATH + "/dev_" + address.replace(":", "_")
+
+class FakeDevice(dbus.service.Object):
+    def __init__(self, bus, address):
+        self.address = address
+        self.connected = False
+        self.path = device_path(address)
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        return {
+            DEVICE_IFACE: {
+                "Address": dbus.String(self.address),
+                "Adapter": dbus.ObjectPath(ADAPTER_PATH),
+                "Connected": dbus.Boolean(self.connected),
+            }
+        }
+
+    def set_connected(self, connected):
+        self.connected = connected
+        self.PropertiesChanged(DEVICE_IFACE, {"Connected": dbus.Boolean(connected)}, [])
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ss", out_signature="v")
+    def Get(self, interface, name):
+        properties = self.get_properties().get(interface)
+        if properties is None or name not in properties:
+            raise InvalidArgsException()
+        return properties[name]
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        if interface != DEVICE_IFACE:
+            raise InvalidArgsException()
+        return self.get_properties()[DEVICE_IFACE]
+
+    @dbus.service.signal(DBUS_PROP_IFACE, signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+class FakeAdapter(dbus.service.Object):
+    def __init__(self, bus, manager):
+        self.bus = bus
+        self.manager = manager
+        self.path = ADAPTER_PATH
+        self.powered = False
+        self.applications = {}
+        self.advertisements = {}
+        self.subscribers = {}
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        return {
+            ADAPTER_IFACE: {
+                "Address": dbus.String(ADAPTER_ADDRESS),
+                "Name": dbus.String("fake-hci0"),
+                "Powered": dbus.Boolean(self.powered),
+            },
+            GATT_MANAGER_IFACE: {},
+            LE_ADVERTISING_MANAGER_IFACE: {
+                "ActiveInstances": dbus.Byte(len(self.advertisements)),
+                "SupportedInstances": dbus.Byte(SUPPORTED_ADVERTISEMENTS - len(self.advertisements)),
+            },
+        }
+
+    def get_proxy(self, sender, path, interface):
+        return dbus.Interface(self.bus.get_object(sender, path, introspect=False), interface)
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ss", out_signature="v")
+    def Get(self, interface, name):
+        properties = self.get_properties().get(interface)
+        if properties is None or name not in properties:
+            raise InvalidArgsException()
+        return properties[name]
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        if interface not in self.get_properties():
+            raise InvalidArgsException()
+        return self.get_properties()[interface]
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ssv")
+    def Set(self, interface, name, value):
+        if interface != ADAPTER_IFACE or name != "Powered":
+            raise NotPermittedException()
+        self.powered = bool(value)
+
+    # Replies are sent once the application's tree has been read back, which
+    # is when real BlueZ considers the application registered.
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="oa{sv}",
+                         sender_keyword="sender", async_callbacks=("reply", "error"))
+    def RegisterApplication(self, path, options, sender, reply, error):
+        key = (sender, path)
+        if key in self.applications:
+            error(AlreadyExistsException())
+            return
+
+        def on_objects(objects):
+            self.applications[key] = objects
+            reply()
+
+        self.get_proxy(sender, path, DBUS_OM_IFACE).GetManagedObjects(
+            reply_handler=on_objects, error_handler=error)
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="o", sender_keyword="sender")
+    def UnregisterApplication(self, path, sender):
+        if self.applications.pop((sender, path), None) is None:
+            raise DoesNotExistException()
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature="oa{sv}",
+                         sender_keyword="sender", async_callbacks=("reply", "error"))
+    def RegisterAdvertisement(self, path, options, sender, reply, error):
+        key = (sender, path)
+        if key in self.advertisements:
+            error(AlreadyExistsException())
+            return
+        if len(self.advertisements) >= SUPPORTED_ADVERTISEMENTS:
+            error(dbus.exceptions.DBusException(
+                "Maximum advertisements reached", name="org.bluez.Error.NotPermitted"))
+            return
+
+        def on_properties(properties):
+            self.advertisements[key] = properties
+            reply()
+
+        self.get_proxy(sender, path, DBUS_PROP_IFACE).GetAll(
+            LE_ADVERTISEMENT_IFACE, reply_handler=on_properties, error_handler=error)
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature="o", sender_keyword="sender")
+    def UnregisterAdvertisement(self, path, sender):
+        if self.advertisements.pop((sender, path), None) is None:
+            raise DoesNotExistException()
+
+    # Test hooks, not part of the BlueZ API
+    @dbus.service.method(FAKE_IFACE, out_signature="a(so)")
+    def GetRegisteredApplications(self):
+        return dbus.Array([dbus.Struct((sender, path)) for sender, path in self.applications],
+                          signature="(so)")
+
+    @dbus.service.method(FAKE_IFACE, out_signature="a(sa{sv})")
+    def GetRegisteredAdvertisements(self):
+        return dbus.Array([dbus.Struct((sender + path, properties))
+                           for (sender, path), properties in self.advertisements.items()],
+                          signature="(sa{sv})")
+
+    # Like BlueZ, only the first subscriber of a characteristic starts it and
+    # only the last one leaving stops it. Replies whether it was started.
+    @dbus.service.method(FAKE_IFACE, in_signature="so", out_signature="b",
+                         sender_keyword="sender", async_callbacks=("reply", "error"))
+    def StartNotify(self, name, path, sender, reply, error):
+        subscribers = self.subscribers.setdefault((name, path), set())
+        first = not subscribers
+        subscribers.add(sender)
+        if not first:
+            reply(False)
+            return
+
+        def on_error(e):
+            self.stop_subscriber(name, path, sender)
+            error(e)
+
+        self.get_proxy(name, path, GATT_CHRC_IFACE).StartNotify(
+            reply_handler=lambda: reply(True), error_handler=on_error)
+
+    @dbus.service.method(FAKE_IFACE, in_signature="so",
+                         sender_keyword="sender", async_callbacks=("reply", "error"))
+    def StopNotify(self, name, path, sender, reply, error):
+        if not self.stop_subscriber(name, path, sender):
+            reply()
+            return
+
+        self.get_proxy(name, path, GATT_CHRC_IFACE).StopNotify(
+            reply_handler=reply, error_handler=error)
+
+    def stop_subscriber(self, name, path, sender):
+        """Drop sender's subscription, True when it was the last one"""
+        subscribers = self.subscribers.get((name, path))
+        if subscribers is None or sender not in subscribers:
+            return False
+
+        subscribers.discard(sender)
+        if subscribers:
+            return False
+        del self.subscribers[(name, path)]
+        return True
+
+    @dbus.service.method(FAKE_IFACE, in_signature="s", out_signature="o")
+    def ConnectDevice(self, address):
+        return self.manager.connect_device(address).path
+
+    @dbus.service.method(FAKE_IFACE, in_signature="o")
+    def DisconnectDevice(self, path):
+        self.manager.disconnect_device(path)
+
+class FakeBluez(dbus.service.Object):
+    """org.bluez root object, owns the adapter and connected devices"""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.name = dbus.service.BusName(BLUEZ_SERVICE_NAME, bus)
+        dbus.service.Object.__init__(self, bus, "/")
+        self.adapter = FakeAdapter(bus, self)
+        self.devices = {}
+
+    def connect_device(self, address):
+        device = self.devices.get(device_path(address))
+        if device is None:
+            device = FakeDevice(self.bus, address)
+            self.devices[device.path] = device
+            self.InterfacesAdded(device.path, device.get_properties())
+
+        device.set_connected(True)
+        return device
+
+    def disconnect_device(self, path):
+        device = self.devices.pop(path, None)
+        if device is None:
+            raise DoesNotExistException()
+
+        device.set_connected(False)
+        self.InterfacesRemoved(path, [DEVICE_IFACE])
+        device.remove_from_connection()
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        response = {self.adapter.path: self.adapter.get_properties()}
+        for path, device in self.devices.items():
+            response[path] = device.get_properties()
+        return response
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature="oa{sa{sv}}")
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature="oas")
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+class FakeCentral(object):
+    """A phone talking to a registered GATT application over its own connection
+
+    Calls block, so run a central from a worker thread when the application
+    lives in the same process. Notifications are delivered on the main loop.
+    """
+
+    def __init__(self, address, name=None, path=None, device_address=None):
+        self.bus = BleTools.connect(address)
+        fake = self.bus.get_object(BLUEZ_SERVICE_NAME, ADAPTER_PATH, introspect=False)
+        self.fake = dbus.Interface(fake, FAKE_IFACE)
+
+        if name is None:
+            applications = self.fake.GetRegisteredApplications()
+            if not applications:
+                raise RuntimeError("no GATT application registered")
+            name, path = applications[0]
+
+        self.name = name
+        self.path = path
+        self.device = None
+        if device_address is not None:
+            self.device = self.fake.ConnectDevice(device_address)
+
+        app = self.bus.get_object(name, path, introspect=False)
+        self.objects = dbus.Interface(app, DBUS_OM_IFACE).GetManagedObjects()
+        self.proxies = {}
+        self.receivers = {}
+
+    def get_options(self, **options):
+        if self.device is not None:
+            options["device"] = dbus.ObjectPath(self.device)
+        return options
+
+    def find_characteristic(self, uuid):
+        for path, interfaces in self.objects.items():
+            chrc = interfaces.get(GATT_CHRC_IFACE)
+            if chrc is not None and chrc["UUID"] == uuid:
+                return path
+        return None
+
+    def get_characteristic(self, path):
+        proxy = self.proxies.get(path)
+        if proxy is None:
+            proxy = dbus.Interface(self.bus.get_object(self.name, path, introspect=False),
+                                   GATT_CHRC_IFACE)
+            self.proxies[path] = proxy
+        return proxy
+
+    def read(self, path, **options):
+        return bytes(self.get_characteristic(path).ReadValue(self.get_options(**options)))
+
+    def write(self, path, value, **options):
+        self.get_characteristic(path).WriteValue(
+            dbus.Array(value, signature="y"), self.get_options(**options))
+
+    def start_notify(self, path, handler):
+        """
+        handler(value) is called with the bytes of every notification. The
+        application only sends an initial value when its first subscriber
+        starts it, later subscribers of a readable characteristic get the
+        current value read back instead.
+        """
+        def on_properties_changed(interface, changed, invalidated):
+            if interface == GATT_CHRC_IFACE and "Value" in changed:
+                handler(bytes(changed["Value"]))
+
+        self.receivers[path] = self.bus.add_signal_receiver(
+            on_properties_changed,
+            dbus_interface=DBUS_PROP_IFACE,
+            signal_name="PropertiesChanged",
+            bus_name=self.name,
+            path=path
+        )
+
+        first = self.fake.StartNotify(self.name, path)
+        if not first and "read" in self.objects[path][GATT_CHRC_IFACE]["Flags"]:
+            handler(self.read(path))
+
+    def stop_notify(self, path):
+        self.fake.StopNotify(self.name, path)
+        receiver = self.receivers.pop(path, None)
+        if receiver is not None:
+            receiver.remove()
+
+    def close(self):
+        for path in list(self.receivers):
+            self.stop_notify(path)
+        if self.device is not None:
+            self.fake.DisconnectDevice(self.device)
+            self.device = None
+        self.bus.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake BlueZ on a private D-Bus daemon")
+    parser.add_argument("--address", help="serve on an existing bus instead of starting one")
+    args = parser.parse_args()
+
+    daemon = None
+    address = args.address
+    if address is None:
+        daemon, address = start_private_bus()
+        print(f"BLE_BUS={address}", flush=True)
+
+    BleTools.set_bus_address(address)
+    # The bus keeps the exported objects alive
+    FakeBluez(BleTools.get_bus())
+    mainloop = BleTools.get_mainloop()
+
+    try:
+        mainloop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+
+if __name__ == "__main__":
+    main()
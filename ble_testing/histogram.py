@@ -0,0 +1,83 @@
+"""HDR style latency histogram.
+
+Values are recorded in integer microseconds into log-linear buckets: exact
+below sub_bucket_count, then sub_bucket_count / 2 buckets per power of two.
+That keeps a fixed relative precision (about 1% for two significant figures)
+over any range with a few hundred sparse counters, and histograms from
+different threads merge by adding counts.
+"""
+
+import math
+
+
+class LatencyHistogram(object):
+    UNIT = 1e-6
+
+    def __init__(self, significant_figures=2):
+        self.sub_bucket_bits = int(math.ceil(math.log2(2 * 10 ** significant_figures)))
+        self.sub_bucket_count = 1 << self.sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = 0
+
+    def bucket(self, value):
+        if value < self.sub_bucket_count:
+            return (0, value)
+
+        shift = value.bit_length() - self.sub_bucket_bits
+        return (shift, value >> shift)
+
+    def bucket_value(self, bucket):
+        """Midpoint of a bucket, in microseconds"""
+        shift, sub = bucket
+        return (sub << shift) + ((1 << shift) >> 1)
+
+    def record(self, seconds):
+        value = max(0, int(round(seconds / self.UNIT)))
+        key = self.bucket(value)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+        if other.minimum is not None and (self.minimum is None or other.minimum < self.minimum):
+            self.minimum = other.minimum
+
+    def percentile(self, percent):
+        """Latency in seconds at or below which percent of samples fall"""
+        if not self.count:
+            return 0.0
+
+        target = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= target:
+                return min(self.bucket_value(key), self.maximum) * self.UNIT
+
+        return self.maximum * self.UNIT
+
+    def to_dict(self):
+        def ms(seconds):
+            return round(seconds * 1000, 3)
+
+        return {
+            "count": self.count,
+            "min_ms": ms((self.minimum or 0) * self.UNIT),
+            "mean_ms": ms(self.total * self.UNIT / self.count) if self.count else 0,
+            "p50_ms": ms(self.percentile(50)),
+            "p90_ms": ms(self.percentile(90)),
+            "p99_ms": ms(self.percentile(99)),
+            "p999_ms": ms(self.percentile(99.9)),
+            "max_ms": ms(self.maximum * self.UNIT),
+        }
@@ -0,0 +1,114 @@
+"""Per object path and method instrumentation of the D-Bus handlers.
+
+Classes deriving from Instrumented get every method named in
+INSTRUMENTED_METHODS wrapped when the class is created, including
+undecorated overrides such as a characteristic's ReadValue. While
+Instrumentation is disabled the wrapper is a single attribute check in
+front of the real handler.
+"""
+
+import collections
+import functools
+import json
+import time
+
+from histogram import LatencyHistogram
+
+INSTRUMENTED_METHODS = (
+    "ReadValue", "WriteValue", "StartNotify", "StopNotify",
+    "AcquireNotify", "AcquireWrite", "GetAll", "GetManagedObjects", "Release",
+)
+
+class CallStats(object):
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.errors = 0
+        self.last_error = None
+
+    def to_dict(self):
+        stats = self.histogram.to_dict()
+        stats["errors"] = self.errors
+        stats["last_error"] = self.last_error
+        return stats
+
+class Instrumentation(object):
+    enabled = False
+    slow_threshold = 0.05
+    slow_calls = collections.deque(maxlen=256)
+    slow_log = None
+    stats = {}
+
+    @classmethod
+    def enable(self, slow_threshold_ms=None, slow_log=None):
+        if slow_threshold_ms is not None:
+            self.slow_threshold = slow_threshold_ms / 1000.0
+        if slow_log is not None:
+            self.slow_log = open(slow_log, "a", buffering=1)
+        self.enabled = True
+
+    @classmethod
+    def disable(self):
+        self.enabled = False
+
+    @classmethod
+    def reset(self):
+        self.stats = {}
+        self.slow_calls.clear()
+
+    @classmethod
+    def record(self, path, method, seconds, error=None):
+        stats = self.stats.get((path, method))
+        if stats is None:
+            stats = self.stats[(path, method)] = CallStats()
+        stats.histogram.record(seconds)
+
+        if error is not None:
+            stats.errors += 1
+            stats.last_error = "%s: %s" % (type(error).__name__, error)
+
+        if seconds >= self.slow_threshold:
+            entry = {
+                "ts": round(time.time(), 3),
+                "path": path,
+                "method": method,
+                "ms": round(seconds * 1000, 3),
+                "error": stats.last_error if error is not None else None,
+            }
+            self.slow_calls.append(entry)
+            if self.slow_log is not None:
+                self.slow_log.write(json.dumps(entry) + "\n")
+
+    @classmethod
+    def snapshot(self):
+        report = {}
+        for (path, method), stats in sorted(self.stats.items()):
+            report.setdefault(path, {})[method] = stats.to_dict()
+        return report
+
+def instrument(method, name):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not Instrumentation.enabled:
+            return method(self, *args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+        except Exception as e:
+            Instrumentation.record(self.path, name, time.perf_counter() - start, e)
+            raise
+        Instrumentation.record(self.path, name, time.perf_counter() - start)
+        return result
+
+    wrapper._instrumented = True
+    return wrapper
+
+class Instrumented(object):
+    """Mixin wrapping the D-Bus handlers of every subclass"""
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in INSTRUMENTED_METHODS:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, "_instrumented", False):
+                setattr(cls, name, instrument(method, name))
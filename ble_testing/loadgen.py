@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+"""Synthetic multi-central load generator for the virtual module.
+
+Simulates N phones/tablets against a test_module.py instance registered
+with fakebluez.py. Each central connects as its own Device1, subscribes to
+time, battery and status notifications, writes timestamp, user ID, target
+time and intensity like the app does when starting a session, then polls
+until the run ends. Per-operation latency histograms and error rates are
+printed and optionally written as JSON.
+
+    python3 fakebluez.py
+    python3 test_module.py --bus $BLE_BUS --headless
+    python3 loadgen.py --bus $BLE_BUS --centrals 20 --duration 30
+"""
+
+import argparse
+import json
+import threading
+import time
+
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from bletools import BleTools
+from codec import ASCII, WIRE_FORMATS, get_codec
+from fakebluez import FakeCentral
+from histogram import LatencyHistogram
+from moduleprofile import compile_profile
+
+PROFILE = compile_profile()
+TIME_UUID = PROFILE.uuid("time")
+INTENSITY_UUID = PROFILE.uuid("intensity")
+TARGET_TIME_UUID = PROFILE.uuid("targetTime")
+STATUS_UUID = PROFILE.uuid("status")
+TIME_STAMP_UUID = PROFILE.uuid("timeStamp")
+USER_ID_UUID = PROFILE.uuid("userId")
+BATTERY_UUID = PROFILE.uuid("battery")
+
+NOTIFY_UUIDS = (TIME_UUID, BATTERY_UUID, STATUS_UUID)
+POLL_UUIDS = (TIME_UUID, INTENSITY_UUID, STATUS_UUID, BATTERY_UUID)
+
+class CentralStats(object):
+    def __init__(self):
+        self.histograms = {}
+        self.errors = {}
+        self.notifications = 0
+
+    def record(self, op, seconds):
+        histogram = self.histograms.get(op)
+        if histogram is None:
+            histogram = self.histograms[op] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def record_error(self, op):
+        self.errors[op] = self.errors.get(op, 0) + 1
+
+    def merge(self, other):
+        for op, histogram in other.histograms.items():
+            self.histograms.setdefault(op, LatencyHistogram()).merge(histogram)
+        for op, count in other.errors.items():
+            self.errors[op] = self.errors.get(op, 0) + count
+        self.notifications += other.notifications
+
+    def to_dict(self):
+        report = {}
+        for op in sorted(set(self.histograms) | set(self.errors)):
+            histogram = self.histograms.get(op, LatencyHistogram())
+            errors = self.errors.get(op, 0)
+            entry = histogram.to_dict()
+            entry["errors"] = errors
+            entry["error_rate"] = round(errors / (histogram.count + errors), 4) if errors else 0
+            report[op] = entry
+        return report
+
+class SimulatedCentral(object):
+    def __init__(self, index, args, stop):
+        self.index = index
+        self.args = args
+        self.stop = stop
+        self.stats = CentralStats()
+        self.address = "02:00:00:00:%02X:%02X" % (index >> 8 & 0xFF, index & 0xFF)
+
+    def timed(self, op, call):
+        start = time.perf_counter()
+        try:
+            result = call()
+        except Exception:
+            self.stats.record_error(op)
+            return None
+        self.stats.record(op, time.perf_counter() - start)
+        return result
+
+    def on_notify(self, value):
+        # Delivered on the main loop thread, a plain int increment is enough
+        self.stats.notifications += 1
+
+    def run(self):
+        central = FakeCentral(self.args.bus, device_address=self.address)
+        try:
+            self.run_script(central)
+        finally:
+            for uuid in NOTIFY_UUIDS:
+                path = central.find_characteristic(uuid)
+                if path in central.receivers:
+                    self.timed("stop_notify", lambda: central.stop_notify(path))
+            central.close()
+
+    def run_script(self, central):
+        paths = {uuid: central.find_characteristic(uuid) for uuid in
+                 set(NOTIFY_UUIDS + POLL_UUIDS) | {TIME_STAMP_UUID, USER_ID_UUID,
+                                                  TARGET_TIME_UUID, INTENSITY_UUID}}
+
+        for uuid in NOTIFY_UUIDS:
+            self.timed("start_notify", lambda: central.start_notify(paths[uuid], self.on_notify))
+
+        mode = self.args.wire_format
+        writes = [
+            ("write_timestamp", TIME_STAMP_UUID,
+             get_codec("string", mode).encode(time.strftime("%d-%m-%YT%H:%M:%S"))),
+            ("write_user_id", USER_ID_UUID,
+             get_codec("string", mode).encode("load-%d" % self.index)),
+            ("write_target_time", TARGET_TIME_UUID,
+             get_codec("uint16", mode).encode(self.args.target_time)),
+            ("write_intensity", INTENSITY_UUID,
+             get_codec("uint8", mode).encode(self.args.intensity)),
+        ]
+        for op, uuid, value in writes:
+            self.timed(op, lambda: central.write(paths[uuid], value))
+
+        while not self.stop.is_set():
+            for uuid in POLL_UUIDS:
+                self.timed("read", lambda: central.read(paths[uuid]))
+            self.stop.wait(self.args.poll_interval / 1000.0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many centrals against a virtual module")
+    parser.add_argument("--bus", default=BleTools.bus_address,
+                        help="address of the private bus running fakebluez.py")
+    parser.add_argument("--centrals", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of polling")
+    parser.add_argument("--poll-interval", type=int, default=250, metavar="MS")
+    parser.add_argument("--ramp", type=float, default=0.0,
+                        help="seconds over which centrals are started")
+    parser.add_argument("--intensity", type=int, default=50)
+    parser.add_argument("--target-time", type=int, default=300)
+    parser.add_argument("--wire-format", choices=WIRE_FORMATS, default=ASCII)
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    BleTools.set_bus_address(args.bus)
+    mainloop = BleTools.get_mainloop()
+    stop = threading.Event()
+    centrals = [SimulatedCentral(index, args, stop) for index in range(args.centrals)]
+    threads = [threading.Thread(target=central.run, daemon=True) for central in centrals]
+
+    def start():
+        for thread in threads:
+            thread.start()
+            if args.ramp and len(threads) > 1:
+                time.sleep(args.ramp / (len(threads) - 1))
+
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        GObject.idle_add(mainloop.quit)
+
+    # Notifications are dispatched by the main loop, the script runs beside it
+    started = time.perf_counter()
+    threading.Thread(target=start, daemon=True).start()
+    mainloop.run()
+    elapsed = time.perf_counter() - started
+
+    total = CentralStats()
+    for central in centrals:
+        total.merge(central.stats)
+
+    report = {
+        "centrals": args.centrals,
+        "seconds": round(elapsed, 3),
+        "notifications": total.notifications,
+        "operations": total.to_dict(),
+    }
+
+    print(f"{'operation':<20}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for op, entry in report["operations"].items():
+        print(f"{op:<20}{entry['count']:>8}{entry['p50_ms']:>10}{entry['p99_ms']:>10}"
+              f"{entry['max_ms']:>10}{entry['errors']:>8}")
+    print(f"notifications received: {total.notifications}")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Line-delimited JSON metrics for headless runs.
+
+Events (session start/completion) are written as they happen. Read/write
+counts, latencies and gauges such as battery level are aggregated in memory
+and written as one "stats" line per flush interval. When no sink is active
+every hook returns straight away.
+"""
+
+import functools
+import json
+import socket
+import sys
+import time
+
+
+class Metrics(object):
+    active = None
+
+    @classmethod
+    def open(self, target):
+        """Open a sink on a file path, "unix:<path>" socket or "-" for stdout"""
+        if target == "-":
+            stream = sys.stdout
+        elif target.startswith("unix:"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(target[len("unix:"):])
+            stream = sock.makefile("w", buffering=1)
+        else:
+            stream = open(target, "a", buffering=1)
+
+        self.active = Metrics(stream)
+        return self.active
+
+    @classmethod
+    def event(self, name, **fields):
+        if self.active is not None:
+            self.active.write(dict(fields, event=name))
+
+    @classmethod
+    def gauge(self, name, key, value):
+        if self.active is not None:
+            self.active.gauges.setdefault(name, {})[key] = value
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.operations = {}
+        self.gauges = {}
+
+    def write(self, record):
+        record["ts"] = round(time.time(), 3)
+        try:
+            self.stream.write(json.dumps(record, separators=(",", ":")) + "\n")
+        except OSError:
+            # The consumer went away, stop collecting rather than fail handlers
+            Metrics.active = None
+
+    def record(self, op, key, latency):
+        stats = self.operations.get((op, key))
+        if stats is None:
+            stats = self.operations[(op, key)] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = max(stats[2], latency)
+
+    def record_error(self, op, key):
+        stats = self.operations.get((op, key))
+        if stats is None:
+            stats = self.operations[(op, key)] = [0, 0.0, 0.0, 0]
+        stats[3] += 1
+
+    def flush(self):
+        operations = {}
+        for (op, key), (count, total, peak, errors) in self.operations.items():
+            operations.setdefault(op, {})[key] = {
+                "count": count,
+                "errors": errors,
+                "mean_ms": round(total * 1000 / count, 3) if count else 0,
+                "max_ms": round(peak * 1000, 3),
+            }
+        self.write({"event": "stats", "operations": operations, "gauges": self.gauges})
+        self.operations = {}
+
+        # Keep the scheduler job running
+        return Metrics.active is self
+
+def timed(op):
+    """Record call count and latency of a handler under op"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            sink = Metrics.active
+            if sink is None:
+                return method(self, *args)
+
+            key = type(self).__name__
+            start = time.perf_counter()
+            try:
+                return method(self, *args)
+            except Exception:
+                sink.record_error(op, key)
+                raise
+            finally:
+                sink.record(op, key, time.perf_counter() - start)
+        return wrapper
+    return decorator
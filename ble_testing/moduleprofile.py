@@ -0,0 +1,250 @@
+"""Declarative module profiles.
+
+A profile is a JSON file (or TOML on Python 3.11+) describing one module
+type: its identity, its GATT services, characteristics and descriptors with
+their flags, codecs and constant values, and the behaviour model serving
+each of them. A profile may extend another and override parts of it:
+
+    {
+      "extends": "virtual_module.json",
+      "identity": {"deviceId": "TMP-VIR"}
+    }
+
+compile_profile() turns a profile into a ProfileTable once per file and wire
+format. The table holds an entry per service, characteristic and descriptor
+with its object path relative to the module's service base, its flags,
+codec, pre-encoded constant value and behaviour model, so creating a module
+from it only instantiates classes at those paths.
+
+Behaviour models are registered by name with register_model() and looked up
+when a module is built, so reading UUIDs from a table (see loadgen.py) does
+not need the classes serving them.
+"""
+
+import collections
+import json
+import os
+
+from codec import ASCII, WIRE_FORMATS, get_codec
+from service import Service, Characteristic, Descriptor, encode_value, to_bytes
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+DEFAULT_PROFILE = "ir_virtual.json"
+
+IDENTITY_FIELDS = ("name", "deviceId", "location", "firmwareVersion")
+
+ServiceEntry = collections.namedtuple("ServiceEntry", [
+    "index", "path", "name", "uuid", "primary", "model", "characteristics",
+])
+CharacteristicEntry = collections.namedtuple("CharacteristicEntry", [
+    "path", "name", "uuid", "flags", "codec", "model", "buffer", "reply",
+    "notifyMinInterval", "notifyMaxInterval", "acquire", "descriptors",
+])
+DescriptorEntry = collections.namedtuple("DescriptorEntry", [
+    "path", "uuid", "flags", "buffer", "reply",
+])
+
+# Behaviour model name -> class serving it
+MODELS = {}
+
+def register_model(name, cls):
+    MODELS[name] = cls
+
+def resolve_model(name, default):
+    if name is None:
+        return default
+    try:
+        return MODELS[name]
+    except KeyError:
+        raise ValueError("unknown behaviour model %r" % name)
+
+def find_profile(name):
+    """Path of a profile given as a path or a file name in PROFILE_DIR"""
+    if os.path.exists(name):
+        return os.path.abspath(name)
+    return os.path.join(PROFILE_DIR, name)
+
+def read_profile(path):
+    if path.endswith(".toml"):
+        # Python 3.11+, JSON profiles work everywhere
+        import tomllib
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+
+    with open(path) as f:
+        return json.load(f)
+
+def load_profile(name):
+    """Profile dict with its extends chain merged in"""
+    path = find_profile(name)
+    profile = read_profile(path)
+
+    base = profile.pop("extends", None)
+    if base is None:
+        return profile
+
+    merged = load_profile(os.path.join(os.path.dirname(path), base))
+    identity = dict(merged.get("identity", {}))
+    identity.update(profile.pop("identity", {}))
+    merged.update(profile)
+    merged["identity"] = identity
+    return merged
+
+def encode_constant(value, codec):
+    """(buffer, reply) for a constant value, or (None, None)"""
+    if value is None:
+        return None, None
+    if codec is not None:
+        value = codec.encode(value)
+    buffer = to_bytes(value)
+    return buffer, encode_value(buffer)
+
+
+class ProfileTable(object):
+    """A compiled profile, shared by every module created from it"""
+
+    def __init__(self, profile, wireFormat):
+        identity = profile.get("identity", {})
+        missing = [field for field in IDENTITY_FIELDS if field not in identity]
+        if missing:
+            raise ValueError("profile identity lacks %s" % ", ".join(missing))
+
+        self.identity = dict((field, identity[field]) for field in IDENTITY_FIELDS)
+        self.wireFormat = wireFormat
+        self.services = tuple(self.compile_service(index, service)
+                              for index, service in enumerate(profile.get("services", [])))
+
+        # Services and characteristics by behaviour model
+        self.by_model = {}
+        for service in self.services:
+            for entry in (service,) + service.characteristics:
+                if entry.model is not None:
+                    self.by_model[entry.model] = entry
+
+    def compile_service(self, index, service):
+        path = "%d" % index
+        return ServiceEntry(
+            index=index,
+            path=path,
+            name=service.get("name", ""),
+            uuid=service["uuid"],
+            primary=bool(service.get("primary", True)),
+            model=service.get("model"),
+            characteristics=tuple(
+                    self.compile_characteristic(path + "/char%d" % chrcIndex, chrc)
+                    for chrcIndex, chrc in enumerate(service.get("characteristics", []))),
+        )
+
+    def compile_characteristic(self, path, chrc):
+        codec = None
+        if chrc.get("codec") is not None:
+            codec = get_codec(chrc["codec"], self.wireFormat)
+
+        buffer, reply = encode_constant(chrc.get("value"), codec)
+        return CharacteristicEntry(
+            path=path,
+            name=chrc.get("name", ""),
+            uuid=chrc["uuid"],
+            flags=list(chrc["flags"]),
+            codec=codec,
+            model=chrc.get("model"),
+            buffer=buffer,
+            reply=reply,
+            notifyMinInterval=chrc.get("notifyMinInterval", 0),
+            notifyMaxInterval=chrc.get("notifyMaxInterval"),
+            acquire=tuple(chrc.get("acquire", ())),
+            descriptors=tuple(self.compile_descriptor(path + "/desc%d" % descIndex, desc)
+                              for descIndex, desc in enumerate(chrc.get("descriptors", []))),
+        )
+
+    def compile_descriptor(self, path, desc):
+        buffer, reply = encode_constant(desc.get("value"), None)
+        return DescriptorEntry(
+            path=path,
+            uuid=desc["uuid"],
+            flags=list(desc.get("flags", ["read"])),
+            buffer=buffer,
+            reply=reply,
+        )
+
+    def uuid(self, model):
+        """UUID of the object served by a behaviour model"""
+        return self.by_model[model].uuid
+
+compiled = {}
+
+def compile_profile(name=DEFAULT_PROFILE, wireFormat=None):
+    """ProfileTable for a profile, compiled on first use"""
+    path = find_profile(name)
+    key = (path, wireFormat)
+
+    table = compiled.get(key)
+    if table is None:
+        profile = load_profile(path)
+        wireFormat = wireFormat or profile.get("wireFormat", ASCII)
+        if wireFormat not in WIRE_FORMATS:
+            raise ValueError("unknown wire format %r" % wireFormat)
+        table = compiled[key] = ProfileTable(profile, wireFormat)
+
+    return table
+
+
+class ProfileService(Service):
+    """A service built from a ServiceEntry, one characteristic per entry"""
+
+    def __init__(self, index, module, entry, path_base=None):
+        self.module = module
+        self.entry = entry
+        self.by_model = {}
+
+        Service.__init__(self, index, entry.uuid, entry.primary, path_base)
+
+        for chrcEntry in entry.characteristics:
+            chrc = resolve_model(chrcEntry.model, ProfileCharacteristic)(self, chrcEntry)
+            if chrcEntry.model is not None:
+                self.by_model[chrcEntry.model] = chrc
+            self.add_characteristic(chrc)
+
+    def characteristic(self, model):
+        return self.by_model[model]
+
+    def object_path(self, entry):
+        """Path of an entry below this service"""
+        # The service's index may differ from the profile's, see benchmark.py
+        return self.path + entry.path[len(self.entry.path):]
+
+class ProfileCharacteristic(Characteristic):
+    """
+    A characteristic built from a CharacteristicEntry. Without a behaviour
+    model it serves its constant value and keeps whatever is written to it.
+    """
+
+    def __init__(self, service, entry):
+        Characteristic.__init__(self, entry.uuid, entry.flags, service, entry.codec,
+                                service.object_path(entry))
+        self.entry = entry
+
+        for descEntry in entry.descriptors:
+            self.add_descriptor(ProfileDescriptor(self, descEntry))
+
+        if entry.reply is not None:
+            self.set_encoded(entry.buffer, entry.reply)
+        if entry.notifyMinInterval or entry.notifyMaxInterval is not None:
+            self.set_notify_intervals(entry.notifyMinInterval, entry.notifyMaxInterval)
+        if entry.acquire:
+            self.set_acquire(notify="notify" in entry.acquire, write="write" in entry.acquire)
+
+    def ReadValue(self, options):
+        return self.read_value(options)
+
+    def WriteValue(self, value, options):
+        value = self.assemble_write(value, options)
+        if value is not None:
+            self.set_value(self.decode(value))
+
+class ProfileDescriptor(Descriptor):
+    def __init__(self, characteristic, entry):
+        Descriptor.__init__(self, entry.uuid, entry.flags, characteristic,
+                            characteristic.service.object_path(entry))
+        if entry.reply is not None:
+            self.set_encoded(entry.buffer, entry.reply)
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+"""Replay a session log against a fresh virtual module.
+
+Modules are built on a ManualClock with the options the log was recorded
+with (fleet size, profiles, wire format, sensor rate, isolation policy),
+each of which can be overridden on the command line. Every recorded write
+is then fed to its characteristic's WriteValue with the original central
+in the options, and recorded subscriptions start and stop notifications,
+while the scheduler advances to each record's timestamp in between. By
+default nothing waits on real time, so hours of clinic traffic replay in
+seconds. The notifications the module emits are captured and compared per
+characteristic with the recorded ones.
+
+    python3 test_module.py --headless --session-log clinic.lmsl
+    python3 replay.py clinic.lmsl --bus $BLE_BUS --output replay.json
+
+Version 1 logs carry neither options nor subscriptions. Their modules are
+guessed from the object paths and every notify characteristic is
+subscribed up front.
+"""
+
+import argparse
+import io
+import json
+import time
+
+import dbus
+import dbus.exceptions
+
+from bletools import BleTools
+from clock import Clock, ManualClock
+from codec import WIRE_FORMATS
+from scheduler import Scheduler
+from sessionlog import SessionLog, read_log, read_open, KIND_NAMES, KIND_OPEN, KIND_WRITE, \
+    KIND_NOTIFY, KIND_START_NOTIFY, KIND_STOP_NOTIFY
+from moduleprofile import DEFAULT_PROFILE
+from test_module import VirtualModule, MODULE_PATH_BASE, FLEET_PROFILES, ARBITRATION_POLICIES, \
+    createFleetModule
+
+def recorded_options(records):
+    """(wall clock time, module options) the log was opened with"""
+    if records and records[0].kind == KIND_OPEN:
+        return read_open(records[0])
+    return None, {}
+
+def build_modules(records, options):
+    """The module or fleet the log was recorded against"""
+    fleet = options.get("fleet") or 0
+    if not fleet:
+        # Older logs only tell the fleet apart by their paths
+        indexes = set()
+        for record in records:
+            if record.target.startswith(MODULE_PATH_BASE):
+                indexes.add(int(record.target[len(MODULE_PATH_BASE):].split("/")[0]))
+        if indexes:
+            fleet = max(indexes) + 1
+
+    profiles = options.get("profiles")
+    wireFormat = options.get("wireFormat")
+    sensorRate = options.get("sensorRate")
+    arbitration = options.get("isolate")
+    if not fleet:
+        return [VirtualModule(0, profiles[0] if profiles else DEFAULT_PROFILE,
+                              wireFormat=wireFormat, sensorRate=sensorRate,
+                              arbitration=arbitration)]
+
+    # Same profile and location per index as test_module.py --fleet
+    return [createFleetModule(index, wireFormat, sensorRate, profiles or FLEET_PROFILES,
+                              arbitration)
+            for index in range(fleet)]
+
+def notifications(records):
+    sent = {}
+    for record in records:
+        if record.kind == KIND_NOTIFY:
+            sent.setdefault(record.target, []).append(record.payload)
+    return sent
+
+def replay(records, modules, speed):
+    characteristics = {}
+    for module in modules:
+        for service in module.app.services:
+            for chrc in service.get_characteristics():
+                characteristics[chrc.path] = chrc
+
+    subscriptions = any(record.kind == KIND_START_NOTIFY for record in records)
+    if not subscriptions:
+        # Stand in for the subscribers a version 1 log does not record
+        for chrc in characteristics.values():
+            if "notify" in chrc.flags:
+                chrc.StartNotify()
+
+    scheduler = Scheduler.get_default()
+    start = time.perf_counter()
+    writes = 0
+    refused = 0
+    missing = 0
+    for record in records:
+        if record.kind not in (KIND_WRITE, KIND_START_NOTIFY, KIND_STOP_NOTIFY):
+            continue
+
+        chrc = characteristics.get(record.target)
+        if chrc is None:
+            missing += 1
+            continue
+
+        scheduler.advance(max(0, record.time - scheduler.now()))
+        if speed:
+            delay = start + record.time / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        if record.kind == KIND_START_NOTIFY:
+            chrc.StartNotify()
+            continue
+        if record.kind == KIND_STOP_NOTIFY:
+            chrc.StopNotify()
+            continue
+
+        options = {"device": dbus.ObjectPath(record.central)} if record.central else {}
+        try:
+            chrc.WriteValue(dbus.Array(record.payload, signature='y'), options)
+            writes += 1
+        except dbus.exceptions.DBusException:
+            # Refused as it was when recorded, e.g. under --isolate first
+            refused += 1
+
+    # Let the last session run out
+    if records:
+        scheduler.advance(max(0, records[-1].time - scheduler.now()))
+    return writes, refused, missing, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a session log against a virtual module")
+    parser.add_argument("log", help="binary session log written with --session-log")
+    parser.add_argument("--bus", default=BleTools.bus_address,
+                        help="bus to export the replayed module on")
+    parser.add_argument("--wire-format", choices=WIRE_FORMATS,
+                        help="override the recorded wire format")
+    parser.add_argument("--profile", action="append", metavar="PROFILE",
+                        help="override the recorded profiles, repeated as for test_module.py")
+    parser.add_argument("--sensor-rate", type=int, metavar="HZ",
+                        help="override the recorded sensor stream rate")
+    parser.add_argument("--isolate", choices=ARBITRATION_POLICIES, metavar="POLICY",
+                        help="override the recorded per-central isolation policy")
+    parser.add_argument("--speed", type=float, default=0, metavar="FACTOR",
+                        help="pace writes at FACTOR times recorded speed, 0 for no waiting")
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    with open(args.log, "rb") as stream:
+        records = list(read_log(stream))
+
+    BleTools.set_bus_address(args.bus)
+    # Simulated wall time starts where the recording did
+    epoch, options = recorded_options(records)
+    Clock.set_default(ManualClock(epoch=epoch))
+
+    overrides = {"profiles": args.profile, "wireFormat": args.wire_format,
+                 "sensorRate": args.sensor_rate, "isolate": args.isolate}
+    options.update((key, value) for key, value in overrides.items() if value is not None)
+    modules = build_modules(records, options)
+
+    capture = SessionLog(io.BytesIO())
+    SessionLog.active = capture
+    writes, refused, missing, elapsed = replay(records, modules, args.speed)
+    SessionLog.active = None
+
+    capture.stream.seek(0)
+    replayed = notifications(list(read_log(capture.stream)))
+    recorded = notifications(records)
+    mismatched = sorted(path for path in recorded if recorded[path] != replayed.get(path, []))
+
+    counts = {}
+    for record in records:
+        name = KIND_NAMES[record.kind]
+        counts[name] = counts.get(name, 0) + 1
+
+    simulated = records[-1].time if records else 0
+    report = {
+        "records": counts,
+        "module_options": options,
+        "writes_replayed": writes,
+        "writes_refused": refused,
+        "records_unmatched": missing,
+        "simulated_seconds": round(simulated, 3),
+        "wall_seconds": round(elapsed, 3),
+        "speedup": round(simulated / elapsed, 1) if elapsed else None,
+        "notifications_recorded": sum(len(values) for values in recorded.values()),
+        "notifications_replayed": sum(len(values) for path, values in replayed.items()
+                                      if path in recorded),
+        "mismatched_characteristics": mismatched,
+    }
+
+    for key, value in report.items():
+        print(f"{key:<28}{value}")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Main loop scheduler for the virtual module.
+
+Every periodic job in the process (battery drain, therapy completion checks,
+notification ticks) lives in one heap ordered by deadline. A single GLib
+timeout is armed for the earliest deadline, so the number of threads and
+main loop sources stays flat no matter how many modules are hosted.
+
+Deadlines are on the scheduler's clock (see clock.py). Under a ManualClock
+no timer is armed and jobs only run from advance(). The timer itself comes
+from GLibTimers by default or AsyncioTimers when the asyncio backend runs.
+"""
+
+import heapq
+import itertools
+import math
+import traceback
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from clock import Clock
+
+
+class ScheduledJob(object):
+    """Cancellation handle returned by the scheduler"""
+
+    def __init__(self, scheduler, callback, args, interval):
+        self.scheduler = scheduler
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.deadline = None
+        self.seq = None
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler.discard(self)
+
+    def reschedule(self, delay):
+        """Move the next run to delay ms from now"""
+        self.cancelled = False
+        self.scheduler.push(self, self.scheduler.now() + delay / 1000.0)
+
+    def is_active(self):
+        return not self.cancelled and self.seq is not None
+
+
+class GLibTimers(object):
+    def add(self, delay, callback):
+        return GObject.timeout_add(delay, callback)
+
+    def remove(self, timer):
+        GObject.source_remove(timer)
+
+    def watch(self, sock, callback):
+        return GObject.io_add_watch(sock.fileno(), GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR,
+                                    lambda fd, condition: callback())
+
+    def unwatch(self, watch):
+        GObject.source_remove(watch)
+
+
+class AsyncioTimers(object):
+    def __init__(self, loop):
+        self.loop = loop
+
+    def add(self, delay, callback):
+        return self.loop.call_later(delay / 1000.0, callback)
+
+    def remove(self, timer):
+        timer.cancel()
+
+    def watch(self, sock, callback):
+        self.loop.add_reader(sock.fileno(), callback)
+        return sock.fileno()
+
+    def unwatch(self, watch):
+        self.loop.remove_reader(watch)
+
+
+class Scheduler(object):
+    default = None
+
+    # Compact the heap once this share of entries is stale
+    STALE_RATIO = 0.5
+
+    @classmethod
+    def get_default(self):
+        if self.default is None:
+            self.default = Scheduler()
+
+        return self.default
+
+    @classmethod
+    def set_default(self, scheduler):
+        self.default = scheduler
+
+    def __init__(self, clock=None, timers=None):
+        self.clock = clock or Clock.get_default()
+        self.timers = timers or GLibTimers()
+        self.queue = []
+        self.counter = itertools.count()
+        self.stale = 0
+        self.timer = None
+        self.timer_deadline = None
+
+    def now(self):
+        return self.clock.now()
+
+    def call_later(self, delay, callback, *args):
+        """Run callback once after delay ms"""
+        job = ScheduledJob(self, callback, args, None)
+        self.push(job, self.now() + delay / 1000.0)
+        return job
+
+    def call_every(self, interval, callback, *args):
+        """Run callback every interval ms until cancelled or it returns False"""
+        job = ScheduledJob(self, callback, args, interval)
+        self.push(job, self.now() + interval / 1000.0)
+        return job
+
+    def watch_fd(self, sock, callback):
+        """Call callback on the main loop whenever sock is readable or closed"""
+        return self.timers.watch(sock, callback)
+
+    def unwatch_fd(self, watch):
+        self.timers.unwatch(watch)
+
+    def push(self, job, deadline):
+        if job.seq is not None:
+            self.stale += 1
+
+        job.deadline = deadline
+        job.seq = next(self.counter)
+        heapq.heappush(self.queue, (deadline, job.seq, job))
+        self.arm()
+
+    def discard(self, job):
+        if job.seq is not None:
+            job.seq = None
+            self.stale += 1
+
+        if self.stale > len(self.queue) * self.STALE_RATIO:
+            self.compact()
+
+    def compact(self):
+        self.queue = [entry for entry in self.queue if entry[1] == entry[2].seq]
+        heapq.heapify(self.queue)
+        self.stale = 0
+
+    def pop_stale(self):
+        while self.queue and self.queue[0][1] != self.queue[0][2].seq:
+            heapq.heappop(self.queue)
+            self.stale = max(0, self.stale - 1)
+
+    def next_deadline(self):
+        self.pop_stale()
+        if not self.queue:
+            return None
+
+        return self.queue[0][0]
+
+    def run_due(self, now):
+        """Run every job whose deadline is at or before now"""
+        self.pop_stale()
+        while self.queue and self.queue[0][0] <= now:
+            deadline, seq, job = heapq.heappop(self.queue)
+            if seq != job.seq:
+                self.stale = max(0, self.stale - 1)
+                continue
+
+            job.seq = None
+            try:
+                result = job.callback(*job.args)
+            except Exception:
+                traceback.print_exc()
+                result = False
+
+            if job.interval is not None and result is not False \
+                    and not job.cancelled and job.seq is None:
+                # Keep a steady cadence unless the job fell a whole interval behind
+                nextDeadline = deadline + job.interval / 1000.0
+                if nextDeadline <= now:
+                    nextDeadline = now + job.interval / 1000.0
+                self.push(job, nextDeadline)
+
+            self.pop_stale()
+
+    def advance(self, seconds):
+        """Step a ManualClock forward, running jobs at their own deadlines"""
+        target = self.now() + seconds
+        deadline = self.next_deadline()
+        while deadline is not None and deadline <= target:
+            self.clock.advance(max(0, deadline - self.now()))
+            self.run_due(deadline)
+            deadline = self.next_deadline()
+
+        self.clock.advance(max(0, target - self.now()))
+
+    def arm(self):
+        if not self.clock.realtime:
+            return
+
+        deadline = self.next_deadline()
+        if deadline is None:
+            self.disarm()
+            return
+
+        if self.timer is not None and self.timer_deadline <= deadline:
+            return
+
+        self.disarm()
+        # Rounded up, a timer firing before the deadline would only re-arm at 0 ms
+        delay = max(0, math.ceil(self.clock.to_real(deadline - self.now()) * 1000))
+        self.timer_deadline = deadline
+        self.timer = self.timers.add(delay, self.on_timer)
+
+    def disarm(self):
+        if self.timer is not None:
+            self.timers.remove(self.timer)
+            self.timer = None
+            self.timer_deadline = None
+
+    def on_timer(self):
+        self.timer = None
+        self.timer_deadline = None
+        self.run_due(self.now())
+        self.arm()
+
+        return False
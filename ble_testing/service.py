@@ -22,12 +22,15 @@ SOFTWARE.
 import dbus
 import dbus.mainloop.glib
 import dbus.exceptions
-try:
-  from gi.repository import GObject
-except ImportError:
-    import gobject as GObject
-from bletools import BleTools
+from bletools import BleTools, export_object
+from scheduler import Scheduler
+from instrumentation import Instrumentation, Instrumented
+from sessionlog import SessionLog
+from connections import ConnectionTracker
 import array
+import json
+import socket
+import traceback
 
 BLUEZ_SERVICE_NAME = "org.bluez"
 GATT_MANAGER_IFACE = "org.bluez.GattManager1"
@@ -36,6 +39,7 @@ DBUS_PROP_IFACE =    "org.freedesktop.DBus.Properties"
 GATT_SERVICE_IFACE = "org.bluez.GattService1"
 GATT_CHRC_IFACE =    "org.bluez.GattCharacteristic1"
 GATT_DESC_IFACE =    "org.bluez.GattDescriptor1"
+DEBUG_IFACE =        "com.lmhealth.Debug1"
 
 DEFAULT_SERVICES = [
     "00001800-0000-1000-8000-00805f9b34fb",  # Generic Access (0x1800)
@@ -48,6 +52,146 @@ DEFAULT_SERVICES = [
     "0000184f-0000-1000-8000-00805f9b34fb",  # Broadcast Audio Scan Service (0x184F)
 ]
 
+def encode_value(value):
+    """Marshal a str or bytes-like value into a ReadValue reply"""
+    if isinstance(value, str):
+        value = value.encode()
+    return dbus.Array(value, signature='y')
+
+def to_bytes(value):
+    if isinstance(value, str):
+        return value.encode()
+    return bytes(value)
+
+# ATT header bytes per Read Blob response and notification
+READ_OVERHEAD = 1
+NOTIFY_OVERHEAD = 3
+DEFAULT_MTU = 23
+
+# Quiet time after the last chunk of a long write before it is applied
+LONG_WRITE_IDLE = 100 # ms
+
+# Option marking a long write passed back through WriteValue once complete
+ASSEMBLED_OPTION = "assembled"
+
+class PendingWrite(object):
+    """Chunks of one central's long write, collected until it completes"""
+
+    def __init__(self, buffer, options):
+        self.buffer = buffer
+        self.options = options
+        self.job = None
+
+class LongValue(object):
+    """
+    offset/mtu handling shared by characteristics and descriptors.
+
+    The raw value is kept as an immutable bytes buffer next to the cached
+    reply. A read at offset 0 that fits the MTU returns the cached reply,
+    longer reads marshal only the requested slice of the buffer.
+
+    BlueZ hands the queued chunks of a long write over on Execute Write as
+    "reliable" writes at increasing offsets, without marking the last one.
+    They are collected per central in a bytearray, and the value completes
+    when that central starts another write or LONG_WRITE_IDLE ms after its
+    last chunk. It is then passed back through WriteValue, so handlers only
+    ever see whole values.
+    """
+
+    def read_value(self, options, value=None):
+        ConnectionTracker.request(options, "read")
+        if value is None:
+            value, buffer = self.value, self.buffer
+        else:
+            buffer = to_bytes(value)
+
+        if value is None:
+            raise NotSupportedException()
+
+        offset = int(options.get("offset", 0))
+        mtu = options.get("mtu")
+        limit = len(buffer) if mtu is None else int(mtu) - READ_OVERHEAD
+        if offset == 0 and len(buffer) <= limit:
+            return value
+        if offset > len(buffer):
+            raise InvalidOffsetException()
+
+        return encode_value(memoryview(buffer)[offset:offset + limit])
+
+    def set_encoded(self, buffer, value):
+        """Take a value encoded ahead of time, buffer and reply may be shared"""
+        self.buffer = buffer
+        self.value = value
+
+    def assemble_write(self, value, options):
+        """Full value to apply for a write, None while a long write is pending"""
+        if options.get(ASSEMBLED_OPTION):
+            return value
+
+        ConnectionTracker.request(options, "write")
+        offset = int(options.get("offset", 0))
+        device = options.get("device")
+
+        if options.get("type") != "reliable":
+            # A single write ends whatever long write the central had going
+            self.complete_write(device)
+            if offset == 0:
+                return value
+
+            # A write into the middle of the current value
+            buffer = bytearray(self.buffer or b"")
+            if offset > len(buffer):
+                raise InvalidOffsetException()
+            buffer[offset:offset + len(value)] = to_bytes(value)
+            return bytes(buffer)
+
+        if offset == 0:
+            self.complete_write(device)
+
+        pending = self.pending_writes.get(device)
+        if pending is not None:
+            buffer = pending.buffer
+        elif offset:
+            # A long write into the middle of the current value
+            buffer = bytearray(self.buffer or b"")
+        else:
+            buffer = bytearray()
+
+        if offset > len(buffer):
+            raise InvalidOffsetException()
+
+        if pending is None:
+            pending = self.pending_writes[device] = PendingWrite(buffer, dict(options))
+        else:
+            pending.job.cancel()
+
+        buffer[offset:offset + len(value)] = to_bytes(value)
+        pending.job = Scheduler.get_default().call_later(
+                LONG_WRITE_IDLE, self.complete_write, device)
+        return None
+
+    def complete_write(self, device):
+        """Apply the long write collected for device, if any"""
+        pending = self.pending_writes.pop(device, None)
+        if pending is None:
+            return
+
+        pending.job.cancel()
+        options = dict(pending.options)
+        options.pop("offset", None)
+        options[ASSEMBLED_OPTION] = True
+        try:
+            self.WriteValue(encode_value(bytes(pending.buffer)), options)
+        except Exception:
+            # The chunks were acknowledged already, there is no reply to fail
+            traceback.print_exc()
+
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InvalidOffset"
+
+class InvalidValueLengthException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InvalidValueLength"
+
 class InvalidArgsException(dbus.exceptions.DBusException):
     _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
 
@@ -57,60 +201,100 @@ class NotSupportedException(dbus.exceptions.DBusException):
 class NotPermittedException(dbus.exceptions.DBusException):
     _dbus_error_name = "org.bluez.Error.NotPermitted"
 
-class Application(dbus.service.Object):
-    def __init__(self):
-        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-        self.mainloop = GObject.MainLoop()
+class Application(Instrumented, dbus.service.Object):
+    def __init__(self, path="/"):
         self.bus = BleTools.get_bus()
-        self.path = "/"
+        self.mainloop = BleTools.get_mainloop()
+        self.path = path
         self.services = []
         self.next_index = 0
-        dbus.service.Object.__init__(self, self.bus, self.path)
-
-        # Add signal receiver for connection monitoring
-        self.bus.add_signal_receiver(
-            self.on_properties_changed,
-            dbus_interface="org.freedesktop.DBus.Properties",
-            signal_name="PropertiesChanged",
-            path_keyword="path"
-        )
-
-    def on_properties_changed(self, interface, changed, invalidated, path):
-        if interface != "org.bluez.Device1":
+        self.managed_objects = {}
+        self.registered = False
+        export_object(self, self.bus, self.path)
+        if self.bus is None:
             return
-            
-        if "Connected" in changed:
-            self.connected = changed["Connected"]
-            if self.connected:
-                # Get the device object to extract MAC address
-                device_proxy = self.bus.get_object("org.bluez", path)
-                device_props = dbus.Interface(device_proxy, "org.freedesktop.DBus.Properties")
-                address = device_props.Get("org.bluez.Device1", "Address")
-                #print(f"\nCENTRAL CONNECTED - MAC: {address}")
-            else:
-                #print("\nCENTRAL DISCONNECTED")
-                pass
+
+        # Connections are tracked once per process, see connections.py
+        ConnectionTracker.start(self.bus)
+
+    @property
+    def connected(self):
+        tracker = ConnectionTracker.default
+        return tracker is not None and len(tracker.centrals) > 0
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
         self.services.append(service)
+        service.application = self
+        for obj in service.get_objects():
+            self.add_object(obj)
+
+    def remove_service(self, service):
+        self.services.remove(service)
+        service.application = None
+        for obj in reversed(service.get_objects()):
+            self.remove_object(obj)
+            if obj.bus is not None:
+                obj.remove_from_connection()
+
+    # The GetManagedObjects reply is kept as a snapshot and patched per object
+    def add_object(self, obj):
+        path = obj.get_path()
+        properties = obj.get_properties()
+        self.managed_objects[path] = properties
+
+        if self.registered:
+            self.InterfacesAdded(path, properties)
+
+    def remove_object(self, obj):
+        path = obj.get_path()
+        properties = self.managed_objects.pop(path, None)
+
+        if properties is not None and self.registered:
+            self.InterfacesRemoved(path, dbus.Array(properties.keys(), signature='s'))
+
+    def update_object(self, obj):
+        path = obj.get_path()
+        if path in self.managed_objects:
+            self.managed_objects[path] = obj.get_properties()
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature = "a{oa{sa{sv}}}")
     def GetManagedObjects(self):
-        response = {}
+        return self.managed_objects
 
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+    # Debug interface onto the handler instrumentation, see instrumentation.py
+    @dbus.service.method(DEBUG_IFACE, out_signature="s")
+    def GetStats(self):
+        return json.dumps(Instrumentation.snapshot())
+
+    @dbus.service.method(DEBUG_IFACE, out_signature="s")
+    def GetSlowCalls(self):
+        return json.dumps(list(Instrumentation.slow_calls))
 
-        return response
+    @dbus.service.method(DEBUG_IFACE, out_signature="s")
+    def GetCentrals(self):
+        return json.dumps(ConnectionTracker.snapshot())
+
+    @dbus.service.method(DEBUG_IFACE, in_signature="bd")
+    def SetInstrumentation(self, enabled, slow_call_ms):
+        if enabled:
+            Instrumentation.enable(slow_call_ms if slow_call_ms > 0 else None)
+        else:
+            Instrumentation.disable()
+
+    @dbus.service.method(DEBUG_IFACE)
+    def ResetStats(self):
+        Instrumentation.reset()
 
     def register_app_callback(self):
         #print("GATT application registered")
@@ -120,16 +304,17 @@ class Application(dbus.service.Object):
         #print("Failed to register application: " + str(error))
         pass
 
-    def register(self):
-        adapter = BleTools.find_adapter(self.bus)
+    def register(self, reply_handler=None, error_handler=None):
+        adapter = BleTools.find_adapter(self.bus, GATT_MANAGER_IFACE)
+        self.registered = True
 
         service_manager = dbus.Interface(
                 self.bus.get_object(BLUEZ_SERVICE_NAME, adapter),
                 GATT_MANAGER_IFACE)
 
         service_manager.RegisterApplication(self.get_path(), {},
-                reply_handler=self.register_app_callback,
-                error_handler=self.register_app_error_callback)
+                reply_handler=reply_handler or self.register_app_callback,
+                error_handler=error_handler or self.register_app_error_callback)
 
     def run(self):
         self.mainloop.run()
@@ -138,34 +323,59 @@ class Application(dbus.service.Object):
         #print("\nGATT application terminated")
         self.mainloop.quit()
 
-class Service(dbus.service.Object):
+class Service(Instrumented, dbus.service.Object):
     PATH_BASE = "/org/bluez/example/service"
 
-    def __init__(self, index, uuid, primary):
+    def __init__(self, index, uuid, primary, path_base=None):
         self.bus = BleTools.get_bus()
-        self.path = self.PATH_BASE + str(index)
+        self.path = (path_base or self.PATH_BASE) + str(index)
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
         self.next_index = 0
-        dbus.service.Object.__init__(self, self.bus, self.path)
+        self.properties = None
+        self.application = None
+        export_object(self, self.bus, self.path)
 
     def get_properties(self):
-        return {
-                GATT_SERVICE_IFACE: {
-                        'UUID': self.uuid,
-                        'Primary': self.primary,
-                        'Characteristics': dbus.Array(
-                                self.get_characteristic_paths(),
-                                signature='o')
-                }
-        }
+        if self.properties is None:
+            self.properties = {
+                    GATT_SERVICE_IFACE: {
+                            'UUID': self.uuid,
+                            'Primary': self.primary,
+                            'Characteristics': dbus.Array(
+                                    self.get_characteristic_paths(),
+                                    signature='o')
+                    }
+            }
+
+        return self.properties
+
+    def invalidate_properties(self):
+        self.properties = None
+        if self.application is not None:
+            self.application.update_object(self)
+
+    def get_application(self):
+        return self.application
+
+    def get_objects(self):
+        """This service followed by every characteristic and descriptor under it"""
+        objects = [self]
+        for chrc in self.characteristics:
+            objects.extend(chrc.get_objects())
+        return objects
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate_properties()
+
+        if self.application is not None:
+            for obj in characteristic.get_objects():
+                self.application.add_object(obj)
 
     def get_characteristic_paths(self):
         result = []
@@ -194,38 +404,101 @@ class Service(dbus.service.Object):
 
         return self.get_properties()[GATT_SERVICE_IFACE]
 
-class Characteristic(dbus.service.Object):
+class Characteristic(Instrumented, LongValue, dbus.service.Object):
     """
     org.bluez.GattCharacteristic1 interface implementation
+
+    Notifications are change driven: set_value queues one PropertiesChanged
+    for the next main loop tick, bursts coalesce into the latest value and
+    values equal to the last one sent are dropped. notify_min_interval spaces
+    notifications out, notify_max_interval resends the last value when
+    nothing changed for that long. Both are in ms.
+
+    With set_acquire() the characteristic also offers BlueZ's fd fast path:
+    AcquireNotify hands out one end of a SOCK_SEQPACKET pair and raw values
+    are sent into it instead of PropertiesChanged, AcquireWrite does the
+    same for incoming writes, which are fed to WriteValue. Values too large
+    for the socket's MTU, or a socket that fails, fall back to the signal.
     """
-    def __init__(self, uuid, flags, service):
+    notify_min_interval = 0
+    notify_max_interval = None
+    acquire_notify = False
+    acquire_write = False
+
+    def __init__(self, uuid, flags, service, codec=None, path=None):
+        # An index is used up either way, so generated paths never collide
         index = service.get_next_index()
-        self.path = service.path + '/char' + str(index)
+        self.path = path or service.path + '/char' + str(index)
         self.bus = service.get_bus()
         self.uuid = uuid
         self.service = service
         self.flags = flags
+        self.codec = codec
         self.descriptors = []
         self.next_index = 0
-        dbus.service.Object.__init__(self, self.bus, self.path)
+        self.value = None
+        self.buffer = None
+        self.pending_writes = {}
+        self.properties = None
+        self.notifying = False
+        self.notify_last = None
+        self.notify_time = None
+        self.notify_job = None
+        self.heartbeat_job = None
+        self.notify_socket = None
+        self.notify_watch = None
+        self.notify_mtu = DEFAULT_MTU
+        self.write_socket = None
+        self.write_watch = None
+        self.write_mtu = DEFAULT_MTU
+        self.write_options = None
+        export_object(self, self.bus, self.path)
 
     def get_properties(self):
-        return {
-                GATT_CHRC_IFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
-        }
+        if self.properties is None:
+            self.properties = {
+                    GATT_CHRC_IFACE: {
+                            'Service': self.service.get_path(),
+                            'UUID': self.uuid,
+                            'Flags': self.flags,
+                            'Descriptors': dbus.Array(
+                                    self.get_descriptor_paths(),
+                                    signature='o')
+                    }
+            }
+
+            # Their presence tells BlueZ the Acquire methods are supported
+            if self.acquire_notify:
+                self.properties[GATT_CHRC_IFACE]['NotifyAcquired'] = \
+                        dbus.Boolean(self.notify_socket is not None)
+            if self.acquire_write:
+                self.properties[GATT_CHRC_IFACE]['WriteAcquired'] = \
+                        dbus.Boolean(self.write_socket is not None)
+
+        return self.properties
+
+    def invalidate_properties(self):
+        self.properties = None
+        application = self.get_application()
+        if application is not None:
+            application.update_object(self)
+
+    def get_application(self):
+        return self.service.get_application()
+
+    def get_objects(self):
+        return [self] + self.descriptors
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.invalidate_properties()
+
+        application = self.get_application()
+        if application is not None:
+            application.add_object(descriptor)
 
     def get_descriptor_paths(self):
         result = []
@@ -236,6 +509,85 @@ class Characteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
+    def encode_bytes(self, value):
+        """Raw bytes of a typed value through this characteristic's codec"""
+        if self.codec is not None:
+            value = self.codec.encode(value)
+        return to_bytes(value)
+
+    def encode(self, value):
+        """Marshal a typed value through this characteristic's codec"""
+        return encode_value(self.encode_bytes(value))
+
+    def decode(self, value):
+        """Parse a WriteValue payload through this characteristic's codec"""
+        if self.codec is not None:
+            return self.codec.decode(value)
+        return bytes(value)
+
+    def set_value(self, value):
+        """Encode value once so reads return the cached reply"""
+        self.buffer = self.encode_bytes(value)
+        self.value = encode_value(self.buffer)
+
+        if self.notifying:
+            self.request_notify()
+
+    def set_encoded(self, buffer, value):
+        LongValue.set_encoded(self, buffer, value)
+
+        if self.notifying:
+            self.request_notify()
+
+    def get_value(self):
+        return self.value
+
+    def set_notify_intervals(self, min_interval=0, max_interval=None):
+        self.notify_min_interval = min_interval
+        self.notify_max_interval = max_interval
+
+    def request_notify(self):
+        if self.notify_job is not None:
+            return
+
+        scheduler = Scheduler.get_default()
+        wait = 0
+        if self.notify_time is not None:
+            wait = self.notify_time + self.notify_min_interval / 1000.0 - scheduler.now()
+        self.notify_job = scheduler.call_later(max(0, wait * 1000), self.flush_notify)
+
+    def notify_now(self):
+        """Send a value queued by set_value without waiting for its flush"""
+        if self.notify_job is not None:
+            self.notify_job.cancel()
+            self.flush_notify()
+
+    def flush_notify(self):
+        self.notify_job = None
+        value = self.get_value()
+
+        if self.notifying and value is not None and value != self.notify_last:
+            self.send_notification(value)
+
+    def set_acquire(self, notify=False, write=False):
+        self.acquire_notify = notify
+        self.acquire_write = write
+        self.invalidate_properties()
+
+    def send_notification(self, value):
+        self.notify_last = value
+        self.notify_time = Scheduler.get_default().now()
+        if self.notify_socket is None or not self.send_acquired(value):
+            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+        SessionLog.notify(self, value)
+
+        if self.heartbeat_job is not None:
+            self.heartbeat_job.reschedule(self.notify_max_interval)
+
+    def send_heartbeat(self):
+        if self.notify_last is not None:
+            self.send_notification(self.notify_last)
+
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
                          out_signature='a{sv}')
@@ -249,23 +601,157 @@ class Characteristic(dbus.service.Object):
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        print('Default ReadValue called, returning error')
-        raise NotSupportedException()
+        return self.read_value(options)
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
         print('Default WriteValue called, returning error')
         raise NotSupportedException()
 
+    def send_acquired(self, value):
+        """Send value through the acquired socket, False to use the signal"""
+        data = self.buffer if value is self.value else to_bytes(value)
+        if len(data) > self.notify_mtu - NOTIFY_OVERHEAD:
+            return False
+
+        try:
+            self.notify_socket.send(data)
+        except BlockingIOError:
+            # The reader is behind, drop it like a congested link would
+            pass
+        except OSError:
+            self.release_notify()
+            return False
+        return True
+
+    def on_notify_socket(self):
+        # The only thing BlueZ does with a notify socket is close it
+        self.release_notify()
+        return True
+
+    def release_notify(self):
+        sock = self.notify_socket
+        if sock is None:
+            return
+
+        self.notify_socket = None
+        Scheduler.get_default().unwatch_fd(self.notify_watch)
+        self.notify_watch = None
+        sock.close()
+        self.invalidate_properties()
+        self.StopNotify()
+
+    def on_write_socket(self):
+        while self.write_socket is not None:
+            try:
+                data = self.write_socket.recv(self.write_mtu)
+            except BlockingIOError:
+                break
+            except OSError:
+                data = b""
+
+            if not data:
+                self.release_write()
+                break
+
+            try:
+                self.WriteValue(encode_value(data), dict(self.write_options))
+            except Exception:
+                # There is no reply to carry the error on this path
+                traceback.print_exc()
+        return True
+
+    def release_write(self):
+        sock = self.write_socket
+        if sock is None:
+            return
+
+        self.write_socket = None
+        Scheduler.get_default().unwatch_fd(self.write_watch)
+        self.write_watch = None
+        sock.close()
+        self.invalidate_properties()
+
+    def acquire_socket(self, callback):
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ours.setblocking(False)
+        watch = Scheduler.get_default().watch_fd(ours, callback)
+
+        # UnixFd holds its own duplicate of the descriptor
+        fd = dbus.types.UnixFd(theirs)
+        theirs.close()
+        return ours, watch, fd
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='a{sv}', out_signature='hq')
+    def AcquireNotify(self, options):
+        if not self.acquire_notify:
+            raise NotSupportedException()
+        if self.notify_socket is not None:
+            raise NotPermittedException()
+
+        self.notify_mtu = int(options.get("mtu", DEFAULT_MTU))
+        self.notify_socket, self.notify_watch, fd = self.acquire_socket(
+                self.on_notify_socket)
+        self.invalidate_properties()
+        ConnectionTracker.subscribed(self, options)
+        self.start_notifying()
+        return (fd, dbus.UInt16(self.notify_mtu))
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='a{sv}', out_signature='hq')
+    def AcquireWrite(self, options):
+        if not self.acquire_write:
+            raise NotSupportedException()
+        if self.write_socket is not None:
+            raise NotPermittedException()
+
+        self.write_mtu = int(options.get("mtu", DEFAULT_MTU))
+        self.write_options = dict((key, options[key]) for key in ("device", "link", "mtu")
+                                  if key in options)
+        self.write_socket, self.write_watch, fd = self.acquire_socket(
+                self.on_write_socket)
+        self.invalidate_properties()
+        ConnectionTracker.request(options, "acquire_write")
+        return (fd, dbus.UInt16(self.write_mtu))
+
     @dbus.service.method(GATT_CHRC_IFACE)
     def StartNotify(self):
-        print('Default StartNotify called, returning error')
-        raise NotSupportedException()
+        if "notify" not in self.flags and "indicate" not in self.flags:
+            print('Default StartNotify called, returning error')
+            raise NotSupportedException()
+
+        ConnectionTracker.subscribed(self)
+        self.start_notifying()
+
+    def start_notifying(self):
+        if self.notifying:
+            return
+
+        self.notifying = True
+        self.notify_last = None
+        SessionLog.start_notify(self)
+        self.request_notify()
+
+        if self.notify_max_interval is not None:
+            self.heartbeat_job = Scheduler.get_default().call_every(
+                    self.notify_max_interval, self.send_heartbeat)
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StopNotify(self):
-        print('Default StopNotify called, returning error')
-        raise NotSupportedException()
+        if "notify" not in self.flags and "indicate" not in self.flags:
+            print('Default StopNotify called, returning error')
+            raise NotSupportedException()
+
+        if self.notifying:
+            SessionLog.stop_notify(self)
+        self.notifying = False
+        ConnectionTracker.unsubscribed(self)
+        if self.notify_job is not None:
+            self.notify_job.cancel()
+            self.notify_job = None
+        if self.heartbeat_job is not None:
+            self.heartbeat_job.cancel()
+            self.heartbeat_job = None
+        self.release_notify()
 
     @dbus.service.signal(DBUS_PROP_IFACE,
                          signature='sa{sv}as')
@@ -282,31 +768,46 @@ class Characteristic(dbus.service.Object):
         return idx
 
     def add_timeout(self, timeout, callback):
-        GObject.timeout_add(timeout, callback)
+        return Scheduler.get_default().call_every(timeout, callback)
 
 
-class Descriptor(dbus.service.Object):
-    def __init__(self, uuid, flags, characteristic):
+class Descriptor(Instrumented, LongValue, dbus.service.Object):
+    def __init__(self, uuid, flags, characteristic, path=None):
         index = characteristic.get_next_index()
-        self.path = characteristic.path + '/desc' + str(index)
+        self.path = path or characteristic.path + '/desc' + str(index)
         self.uuid = uuid
         self.flags = flags
         self.chrc = characteristic
         self.bus = characteristic.get_bus()
-        dbus.service.Object.__init__(self, self.bus, self.path)
+        self.value = None
+        self.buffer = None
+        self.pending_writes = {}
+        self.properties = None
+        export_object(self, self.bus, self.path)
 
     def get_properties(self):
-        return {
-                GATT_DESC_IFACE: {
-                        'Characteristic': self.chrc.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                }
-        }
+        if self.properties is None:
+            self.properties = {
+                    GATT_DESC_IFACE: {
+                            'Characteristic': self.chrc.get_path(),
+                            'UUID': self.uuid,
+                            'Flags': self.flags,
+                    }
+            }
+
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
+    def set_value(self, value):
+        """Encode value once so reads return the cached reply"""
+        self.buffer = to_bytes(value)
+        self.value = encode_value(self.buffer)
+
+    def get_value(self):
+        return self.value
+
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
                          out_signature='a{sv}')
@@ -320,8 +821,7 @@ class Descriptor(dbus.service.Object):
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        print ('Default ReadValue called, returning error')
-        raise NotSupportedException()
+        return self.read_value(options)
 
     @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
@@ -0,0 +1,175 @@
+"""Append-only binary log of GATT writes, notifications and session transitions.
+
+The file starts with a 5 byte header (magic, version) followed by records:
+
+    <d  seconds since the log was opened, on the module clock
+    B   record kind
+    H   central string id (0 when not known)
+    H   target string id, the object path
+    H   payload length
+        payload, the value or the transition name
+
+Strings are interned: the first use of a path or device writes a STRING
+record carrying its id and text, so a record costs 15 bytes plus the value.
+Every open appends an OPEN record with the wall clock time, followed by the
+module options as JSON, and starts a new string table. read_log() stitches
+those segments into one timeline. START_NOTIFY and STOP_NOTIFY records mark
+when a characteristic gained its first subscriber and lost its last one.
+See replay.py for feeding a log back into a module.
+
+Version 1 logs have no options and no subscription records, they are still
+read.
+"""
+
+import collections
+import json
+import struct
+import time
+
+from clock import Clock
+
+MAGIC = b"LMSL"
+VERSION = 2
+READ_VERSIONS = (1, 2)
+
+HEADER = struct.Struct("<4sB")
+RECORD = struct.Struct("<dBHHH")
+OPEN_PAYLOAD = struct.Struct("<d")
+
+KIND_OPEN = 0
+KIND_STRING = 1
+KIND_WRITE = 2
+KIND_NOTIFY = 3
+KIND_STATE = 4
+KIND_START_NOTIFY = 5
+KIND_STOP_NOTIFY = 6
+
+KIND_NAMES = {
+    KIND_OPEN: "open",
+    KIND_STRING: "string",
+    KIND_WRITE: "write",
+    KIND_NOTIFY: "notify",
+    KIND_STATE: "state",
+    KIND_START_NOTIFY: "start_notify",
+    KIND_STOP_NOTIFY: "stop_notify",
+}
+
+LogRecord = collections.namedtuple("LogRecord", "time kind central target payload")
+
+
+class SessionLog(object):
+    active = None
+
+    @classmethod
+    def open(self, target, options=None):
+        self.active = SessionLog(open(target, "ab"), options=options)
+        return self.active
+
+    @classmethod
+    def write(self, chrc, value, options):
+        if self.active is not None:
+            self.active.append(KIND_WRITE, str(options.get("device", "")), chrc.path, bytes(value))
+
+    @classmethod
+    def notify(self, chrc, value):
+        if self.active is not None:
+            self.active.append(KIND_NOTIFY, "", chrc.path, bytes(value))
+
+    @classmethod
+    def start_notify(self, chrc):
+        if self.active is not None:
+            self.active.append(KIND_START_NOTIFY, "", chrc.path, b"")
+
+    @classmethod
+    def stop_notify(self, chrc):
+        if self.active is not None:
+            self.active.append(KIND_STOP_NOTIFY, "", chrc.path, b"")
+
+    @classmethod
+    def state(self, service, name, central=""):
+        if self.active is not None:
+            self.active.append(KIND_STATE, central, service.path, name.encode())
+
+    def __init__(self, stream, clock=None, options=None):
+        self.stream = stream
+        self.clock = clock or Clock.get_default()
+        self.origin = self.clock.now()
+        self.strings = {"": 0}
+
+        if stream.tell() == 0:
+            stream.write(HEADER.pack(MAGIC, VERSION))
+        self.append(KIND_OPEN, "", "", OPEN_PAYLOAD.pack(time.time()) +
+                    json.dumps(options or {}, sort_keys=True).encode())
+
+    def intern(self, text):
+        ident = self.strings.get(text)
+        if ident is None:
+            ident = self.strings[text] = len(self.strings)
+            self.append_record(KIND_STRING, 0, ident, text.encode())
+        return ident
+
+    def append(self, kind, central, target, payload):
+        self.append_record(kind, self.intern(central), self.intern(target), payload)
+
+    def append_record(self, kind, central, target, payload):
+        try:
+            self.stream.write(RECORD.pack(self.clock.now() - self.origin, kind,
+                                          central, target, len(payload)) + payload)
+        except OSError:
+            # Never fail a GATT handler because the log went away
+            SessionLog.active = None
+
+    def flush(self):
+        try:
+            self.stream.flush()
+        except OSError:
+            SessionLog.active = None
+
+        # Keep the scheduler job running
+        return SessionLog.active is self
+
+    def close(self):
+        if SessionLog.active is self:
+            SessionLog.active = None
+        self.stream.close()
+
+
+def read_log(stream):
+    """Yield LogRecords from a binary stream, with strings resolved"""
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return
+
+    magic, version = HEADER.unpack(header)
+    if magic != MAGIC or version not in READ_VERSIONS:
+        raise ValueError("Not a version %d session log" % VERSION)
+
+    strings = {0: ""}
+    offset = 0.0
+    last = 0.0
+    while True:
+        head = stream.read(RECORD.size)
+        if len(head) < RECORD.size:
+            # A truncated tail is what a crash leaves behind
+            return
+
+        seconds, kind, central, target, length = RECORD.unpack(head)
+        payload = stream.read(length)
+        if len(payload) < length:
+            return
+
+        if kind == KIND_STRING:
+            strings[target] = payload.decode()
+            continue
+        if kind == KIND_OPEN:
+            strings = {0: ""}
+            offset = last
+
+        last = offset + seconds
+        yield LogRecord(last, kind, strings.get(central, ""), strings.get(target, ""), payload)
+
+def read_open(record):
+    """(wall clock time, module options) of an OPEN record"""
+    wall_time, = OPEN_PAYLOAD.unpack_from(record.payload)
+    options = record.payload[OPEN_PAYLOAD.size:]
+    return wall_time, json.loads(options.decode()) if options else {}
@@ -21,25 +21,59 @@ SOFTWARE.
 #!/usr/bin/python3
 
 # Bluetooth Related
-import dbus
-from advertisement import Advertisement
-from service import Application, Service, Characteristic, Descriptor
+from advertisement import Advertisement, AdvertisementManager
+from bletools import BleTools
+from service import Application, Descriptor, encode_value, DEFAULT_MTU, NOTIFY_OVERHEAD, \
+    InvalidArgsException, InvalidValueLengthException, NotPermittedException, NotSupportedException
+from moduleprofile import ProfileService, ProfileCharacteristic, DEFAULT_PROFILE, \
+    compile_profile, register_model, resolve_model
+from scheduler import Scheduler, AsyncioTimers
+from clock import Clock, RealClock, ScaledClock
+from metrics import Metrics, timed
+from instrumentation import Instrumentation
+from sessionlog import SessionLog
+from connections import ConnectionTracker
+from codec import WIRE_FORMATS
 
 # Functionality 
+import argparse
+import asyncio
+import collections
+import struct
 import time
 import threading
 import curses
 from curses import wrapper
 
+try:
+    import numpy
+except ImportError:
+    numpy = None # Only needed for the sensor stream
+
 
 # Constants
 GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
-NOTIFY_TIMEOUT = 5000
+BATTERY_DRAIN_INTERVAL = 5000
+THERAPY_CHECK_INTERVAL = 1000
+METRICS_INTERVAL = 1000
+SESSION_LOG_FLUSH_INTERVAL = 1000
+
+# Session History
+HISTORY_CAPACITY = 1024
+HISTORY_BATCH = 32 # Packets sent per main loop iteration
+
+# Sensor Stream
+SENSOR_MIN_RATE = 10
+SENSOR_MAX_RATE = 500
+SENSOR_TICK_INTERVAL = 50 # ms between generated blocks
+SENSOR_BUFFER_SIZE = 1024 # Samples held while notifications catch up
 
-VIRTUAL_DEVICE_NAME = "LM Health Virtual"
-VIRTUAL_DEVICE_ID = "IR-VIR" # TMP-VIR VBR-VIR IR-VIR
-VIRTUAL_LOCATION = 2
-VIRTUAL_FIRMWARE_VERSION = "1.0.0"
+# Per-central session isolation, see TherapyService.setIsolation
+ARBITRATION_POLICIES = ("first", "latest")
+
+# Fleet Mode
+MODULE_PATH_BASE = "/org/bluez/example/module"
+FLEET_PROFILES = ["tmp_virtual.json", "vbr_virtual.json", "ir_virtual.json"]
 
 class bcolors:
     HEADER = '\033[95m'
@@ -56,11 +90,18 @@ class bcolors:
 uiScreen = None
 batteryWindow = None
 therapyWindow = None
+statusWindow = None
+deviceInfoWindow = None
+
+# Only one module of a fleet is drawn on the curses screen
+displayedModule = None
+uiRenderer = None
 
 # =============================================== UI ===============================================
-def initUi():
+def initUi(module):
     """Initialize the curses UI with multiple windows"""
-    global uiScreen, batteryWindow, therapyWindow, statusWindow, deviceInfoWindow
+    global uiScreen, batteryWindow, therapyWindow, statusWindow, deviceInfoWindow, displayedModule, uiRenderer
+    displayedModule = module
     
     # Initialize curses
     uiScreen = curses.initscr()
@@ -73,7 +114,7 @@ def initUi():
     
     # Create windows with borders
     # 1. Advertising status (top)
-    uiScreen.addstr(0, 2, f" Advertising as {VIRTUAL_DEVICE_NAME}... ")
+    uiScreen.addstr(0, 2, f" Advertising as {module.name}... ")
     uiScreen.refresh()
     
     # 2. Battery window (row 1)
@@ -102,25 +143,101 @@ def initUi():
     statusWindow.refresh()
     deviceInfoWindow.refresh()
 
+    uiRenderer = UiRenderer()
+    uiRenderer.start()
+
 def closeUi():
     """Clean up the curses UI"""
-    global uiScreen
+    global uiRenderer
+    if uiRenderer:
+        uiRenderer.stop()
+        uiRenderer = None
+
     if uiScreen:
         curses.nocbreak()
         uiScreen.keypad(False)
         curses.echo()
         curses.endwin()
 
-def updateBatteryUi(percent):
-    """Update the battery progress bar"""
-    global batteryWindow
-    if not batteryWindow:
-        return
-    
+class UiRenderer(object):
+    """Draws the curses windows from published state on a single thread
+
+    D-Bus handlers and scheduler jobs only publish state. The render thread
+    wakes on a change, takes a snapshot of the dirty windows and redraws just
+    those, at most once per frame interval.
+    """
+    FRAME_INTERVAL = 0.1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+        self.dirty = set()
+        self.drawn = {}
+        self.state = {
+            "battery": {"percent": 100},
+            "therapy": {"elapsed": 0, "target": 0, "completed": None},
+            "status": {"intensity": 0, "targetTime": 0, "userId": "", "timestamp": "",
+                       "statusText": None, "error": None},
+            "deviceInfo": {"deviceId": "", "location": 0, "firmwareVersion": ""},
+        }
+        self.draw = {
+            "battery": drawBatteryWindow,
+            "therapy": drawTherapyWindow,
+            "status": drawStatusWindow,
+            "deviceInfo": drawDeviceInfoWindow,
+        }
+
+    def publish(self, window, **values):
+        with self.lock:
+            self.state[window].update(values)
+            self.dirty.add(window)
+        self.wake.set()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while self.running:
+            self.wake.wait()
+            self.wake.clear()
+
+            with self.lock:
+                dirty = self.dirty
+                self.dirty = set()
+                snapshot = {window: dict(self.state[window]) for window in dirty}
+
+            if not self.running:
+                break
+
+            for window, state in snapshot.items():
+                if self.drawn.get(window) != state:
+                    self.draw[window](state)
+                    self.drawn[window] = state
+            curses.doupdate()
+
+            # Cap the frame rate, later changes coalesce into the next frame
+            time.sleep(self.FRAME_INTERVAL)
+
+def publishUi(module, window, **values):
+    if uiRenderer and module is displayedModule:
+        uiRenderer.publish(window, **values)
+
+def drawBatteryWindow(state):
+    percent = state["percent"]
     width = int((batteryWindow.getmaxyx()[1] - 4) * 0.9)
     filled = int(width * percent / 100)
     
-    batteryWindow.clear()
+    batteryWindow.erase()
     batteryWindow.border()
     batteryWindow.addstr(0, 2, " Battery Life ")
     
@@ -130,14 +247,11 @@ def updateBatteryUi(percent):
     
     # Add percentage
     batteryWindow.addstr(1, width + 4, f"{percent}%")
-    batteryWindow.refresh()
+    batteryWindow.noutrefresh()
 
-def updateTherapyUi(elapsed, target):
-    """Update the therapy progress bar with rounded time values"""
-    global therapyWindow
-    if not therapyWindow:
-        return
-    
+def drawTherapyWindow(state):
+    elapsed = state["elapsed"]
+    target = state["target"]
     width = int((therapyWindow.getmaxyx()[1] - 4) * 0.9)
     
     # Round elapsed time to whole number
@@ -150,7 +264,7 @@ def updateTherapyUi(elapsed, target):
         filled = 0
         time_str = "Inactive"
     
-    therapyWindow.clear()
+    therapyWindow.erase()
     therapyWindow.border()
     therapyWindow.addstr(0, 2, " Therapy Progress ")
     
@@ -160,16 +274,16 @@ def updateTherapyUi(elapsed, target):
     
     # Add time display right after progress bar
     therapyWindow.addstr(1, width + 4, time_str)
-    therapyWindow.refresh()
 
+    if state["completed"] is not None:
+        therapyWindow.addstr(2, 2, f"Therapy completed after {state['completed']}s")
+    therapyWindow.noutrefresh()
 
-def updateStatusUi(intensity, targetTime, userId, timestamp):
-    """Update the status window with improved layout"""
-    global statusWindow
-    if not statusWindow:
-        return
-    
-    statusWindow.clear()
+def drawStatusWindow(state):
+    intensity = state["intensity"]
+    targetTime = state["targetTime"]
+
+    statusWindow.erase()
     statusWindow.border()
     statusWindow.addstr(0, 2, " Therapy Status ")
     
@@ -177,728 +291,1221 @@ def updateStatusUi(intensity, targetTime, userId, timestamp):
     statusWindow.addstr(1, 2, f"Intensity: {intensity}%")
     statusWindow.addstr(1, 25, f"Target Time: {targetTime}s")
 
-    status = "ACTIVE" if (intensity > 0 and targetTime > 0) else "INACTIVE"
+    status = state["statusText"]
+    if status is None:
+        status = "ACTIVE" if (intensity > 0 and targetTime > 0) else "INACTIVE"
     statusWindow.addstr(1, 50, f"Status: {status}")
     
     # Line 2: User ID and Timestamp on same row
-    userDisplay = userId if userId else "Not set"
-    timeStampDisplay = timestamp if timestamp else "Not set"
+    userDisplay = state["userId"] if state["userId"] else "Not set"
+    timeStampDisplay = state["timestamp"] if state["timestamp"] else "Not set"
     statusWindow.addstr(2, 2, f"User: {userDisplay}")
     statusWindow.addstr(2, 25, f"Timestamp: {timeStampDisplay}")
-    
-    statusWindow.refresh()
 
-def updateDeviceInfoUi():
-    """Update the device information window with all device details"""
-    global deviceInfoWindow
-    if not deviceInfoWindow:
-        return
+    if state["error"] is not None:
+        statusWindow.addstr(3, 40, f"Error: {state['error']}")
     
-    deviceInfoWindow.clear()
+    statusWindow.noutrefresh()
+
+def drawDeviceInfoWindow(state):
+    deviceInfoWindow.erase()
     deviceInfoWindow.border()
     deviceInfoWindow.addstr(0, 2, " Device Information ")
     
     # Line 1: Device ID, Location, and Firmware Version
-    deviceInfoWindow.addstr(1, 2, f"ID: {VIRTUAL_DEVICE_ID}")
-    deviceInfoWindow.addstr(1, 25, f"Location: 0x{VIRTUAL_LOCATION:02X}")
-    deviceInfoWindow.addstr(1, 50, f"Firmware: {VIRTUAL_FIRMWARE_VERSION}")
+    deviceInfoWindow.addstr(1, 2, f"ID: {state['deviceId']}")
+    deviceInfoWindow.addstr(1, 25, f"Location: 0x{state['location']:02X}")
+    deviceInfoWindow.addstr(1, 50, f"Firmware: {state['firmwareVersion']}")
     
-    deviceInfoWindow.refresh()
+    deviceInfoWindow.noutrefresh()
+
+# Handlers call these to publish state, none of them touch curses directly
+def updateBatteryUi(module, percent):
+    """Update the battery progress bar"""
+    publishUi(module, "battery", percent=percent)
+
+def updateTherapyUi(module, elapsed, target):
+    """Update the therapy progress bar with rounded time values"""
+    if target > 0:
+        publishUi(module, "therapy", elapsed=elapsed, target=target, completed=None)
+    else:
+        publishUi(module, "therapy", elapsed=elapsed, target=target)
 
-def showTherapyStarted(userId, timestamp):
+def updateStatusUi(module, intensity, targetTime, userId, timestamp):
+    """Update the status window with improved layout"""
+    publishUi(module, "status", intensity=intensity, targetTime=targetTime,
+              userId=userId, timestamp=timestamp, statusText=None, error=None)
+
+def updateDeviceInfoUi(module):
+    """Update the device information window with all device details"""
+    publishUi(module, "deviceInfo", deviceId=module.deviceId, location=module.location,
+              firmwareVersion=module.firmwareVersion)
+
+def showTherapyStarted(module, userId, timestamp):
     """Display therapy started message"""
-    global statusWindow
-    if not statusWindow:
-        return
-    
-    statusWindow.addstr(1, 50, "Status: ACTIVE")
-    statusWindow.addstr(2, 2, f"User: {userId}")
-    statusWindow.addstr(3, 2, f"Timestamp: {timestamp}")
-    statusWindow.refresh()
+    publishUi(module, "status", statusText="ACTIVE", userId=userId, timestamp=timestamp)
 
-def showTherapyCompleted(targetTime):
+def showTherapyCompleted(module, targetTime):
     """Display therapy completed message"""
-    global therapyWindow
-    if not therapyWindow:
-        return
-    
-    therapyWindow.addstr(2, 2, f"Therapy completed after {targetTime}s")
-    therapyWindow.refresh()
+    publishUi(module, "therapy", completed=targetTime)
+
+def showStatusText(module, text):
+    """Display the current therapy status"""
+    publishUi(module, "status", statusText=text)
+
+def showError(module, error):
+    """Display an error raised by a characteristic handler"""
+    publishUi(module, "status", error=str(error))
 
 # ===============================================================================================================
 # =============================================== ADVERTISEMENT =================================================
 # ===============================================================================================================
 
 class TherapyAdvertisement(Advertisement):
-    def __init__(self, index):
+    def __init__(self, index, name):
         Advertisement.__init__(self, index, "peripheral")
         # self.add_local_name("LMTherapy-Module")
-        self.add_local_name(VIRTUAL_DEVICE_NAME)
-        self.include_tx_power = True
+        self.add_local_name(name)
+        self.set_include_tx_power(True)
 
 # ===============================================================================================================
 # =============================================== INFO SERVICE ==================================================
 # ===============================================================================================================
 
-class InfoService(Service):
-    INFO_SVC_UUID = "00000011-710e-4a5b-8d75-3e5b444bc3cf"
-
-    def __init__(self, index):
-
-        Service.__init__(self, index, self.INFO_SVC_UUID, True)
-        self.add_characteristic(DeviceIdCharacteristic(self))
-        self.add_characteristic(LocationIdCharacteristic(self))
-        self.add_characteristic(BatteryLifeCharacteristic(self))
-        self.add_characteristic(FirmwareVersionCharacteristic(self))
+class InfoService(ProfileService):
+    pass
 
 # =============================================== CHARACTERISTICS ===============================================
 
 
-class DeviceIdCharacteristic(Characteristic):
-    DEVICE_ID_CHARACTERISTIC_UUID = "00000012-710e-4a5b-8d75-3e5b444bc3cf"
-    DEVICE_ID_CHARACTERISTIC_VALUE = VIRTUAL_DEVICE_ID
-
-    def __init__(self, service):
-        Characteristic.__init__(
-                self, self.DEVICE_ID_CHARACTERISTIC_UUID,
-                ["read"],
-                service)
-
-    def ReadValue(self, options):
-        value = []
-        desc = self.DEVICE_ID_CHARACTERISTIC_VALUE
-
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-            
-        updateDeviceInfoUi()
-        return value
-
-class LocationIdCharacteristic(Characteristic):
-    LOCATION_ID_CHARACTERISTIC_UUID = "00000013-710e-4a5b-8d75-3e5b444bc3cf"
-    LOCATION_ID_CHARACTERISTIC_VALUE = VIRTUAL_LOCATION
-
-    def __init__(self, service):
-        Characteristic.__init__(
-                self, self.LOCATION_ID_CHARACTERISTIC_UUID,
-                ["read"],
-                service)
+class DeviceIdCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.set_value(service.module.deviceId)
 
+    @timed("read")
     def ReadValue(self, options):
-        value = []
-        desc = f"0x{self.LOCATION_ID_CHARACTERISTIC_VALUE:02X}"
+        updateDeviceInfoUi(self.service.module)
+        return self.read_value(options)
 
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
+class LocationIdCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.set_value(service.module.location)
 
-        updateDeviceInfoUi()
-        return value
+    @timed("read")
+    def ReadValue(self, options):
+        updateDeviceInfoUi(self.service.module)
+        return self.read_value(options)
     
-class BatteryLifeCharacteristic(Characteristic):
-    BATTERY_LIFE_CHARACTERISTIC_UUID = "00000014-710e-4a5b-8d75-3e5b444bc3cf"
-
-    def __init__(self, service):
+class BatteryLifeCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
         self.batteryLife = 100
-        Characteristic.__init__(
-                self, self.BATTERY_LIFE_CHARACTERISTIC_UUID,
-                ["notify", "read"],
-                service)
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.set_value(self.batteryLife)
         
-        # Start the background battery drain thread
-        self.batteryDrainThread = threading.Thread(target=self.batteryDrainLoop, daemon=True)
-        self.batteryDrainThread.start()
-
-    def batteryDrainLoop(self):
-        while True:
-            time.sleep(5)
-            self.batteryLife -= 1
+        # Drain the battery from the shared main loop scheduler
+        self.batteryDrainJob = Scheduler.get_default().call_every(
+                BATTERY_DRAIN_INTERVAL, self.drainBattery)
 
-            if (self.batteryLife <= 0):
-                self.batteryLife = 100
+    def drainBattery(self):
+        self.batteryLife -= 1
 
-            # Update UI
-            updateBatteryUi(self.batteryLife)
+        if (self.batteryLife <= 0):
+            self.batteryLife = 100
 
-    def getBatteryLife(self):
-        value = []
-        strBatteryLife = str(self.batteryLife)
-
-        for c in strBatteryLife:
-            value.append(dbus.Byte(c.encode()))
-        return value
+        self.set_value(self.batteryLife)
 
-    def setBatteryLifeCallback(self):
-        if self.notifying:
-            value = self.getBatteryLife()
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-        return self.notifying
+        # Update UI
+        updateBatteryUi(self.service.module, self.batteryLife)
+        Metrics.gauge("battery", self.service.module.name, self.batteryLife)
 
-    def StartNotify(self):
-        if self.notifying:
-            return
-        self.notifying = True
-
-        value = self.getBatteryLife()
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-        self.add_timeout(NOTIFY_TIMEOUT, self.setBatteryLifeCallback)
-
-    def StopNotify(self):
-        self.notifying = False
+    def getBatteryLife(self):
+        return self.get_value()
 
+    @timed("read")
     def ReadValue(self, options):
-        value = self.getBatteryLife()
-        return value
-
-class FirmwareVersionCharacteristic(Characteristic):
-    FIRMWARE_VERSION_CHARACTERISTIC_UUID = "00000015-710e-4a5b-8d75-3e5b444bc3cf"
-    FIRMWARE_VERSION_CHARACTERISTIC_VALUE = VIRTUAL_FIRMWARE_VERSION
+        return self.read_value(options)
 
-    def __init__(self, service):
-        Characteristic.__init__(
-                self, self.FIRMWARE_VERSION_CHARACTERISTIC_UUID,
-                ["read"],
-                service)
+class FirmwareVersionCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.set_value(service.module.firmwareVersion)
 
+    @timed("read")
     def ReadValue(self, options):
-        value = []
-        desc = self.FIRMWARE_VERSION_CHARACTERISTIC_VALUE
-
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-
-        updateDeviceInfoUi()
-        return value
+        updateDeviceInfoUi(self.service.module)
+        return self.read_value(options)
 
 # ===============================================================================================================
 # =============================================== THERAPY SERVICE ===============================================
 # ===============================================================================================================
 
-class TherapyService(Service):
-    THERAPY_SVC_UUID = "00000001-710e-4a5b-8d75-3e5b444bc3cf"
+TherapyState = collections.namedtuple("TherapyState", [
+    "version", "intensity", "targetTime", "startTime", "elapsedTime",
+    "isTherapyActive", "timeStamp", "userId",
+])
+
+class TherapyService(ProfileService):
+    """
+    Session state lives in one immutable TherapyState. Mutations happen on
+    the main loop and swap in a new snapshot with the next version, so any
+    reader (handlers, the UI thread, replay tooling) gets a consistent view
+    from a single attribute read. Watchers are called with the old and new
+    snapshot on every change, and threads can block in waitForChange().
+
+    With setIsolation() every central writes and reads its own snapshot,
+    keyed by device path. self.state is then the view of the central that
+    owns the actuator; only a central starting a session can become owner,
+    as decided by the arbitration policy.
+    """
+
+    def __init__(self, index, module, entry, path_base=None):
+        self.idle = self.state = TherapyState(
+            version=0, intensity=0, targetTime=0, startTime=0, elapsedTime=0,
+            isTherapyActive=False, timeStamp='', userId='')
+        self.watchers = []
+        self.changed = threading.Condition()
+
+        self.arbitration = None
+        self.views = {}
+        self.owner = None
+        self.ownerGone = False
+
+        ProfileService.__init__(self, index, module, entry, path_base)
+
+        self.timeCharacteristic = self.characteristic("time")
+        self.intensityCharacteristic = self.characteristic("intensity")
+        self.targetTimeCharacteristic = self.characteristic("targetTime")
+        self.statusCharacteristic = self.characteristic("status")
+        self.timeStampCharacteristic = self.characteristic("timeStamp")
+        self.userIdCharacteristic = self.characteristic("userId")
+
+        # Readable values whose cached characteristic reply follows the state
+        self.stateCharacteristics = (
+            ("intensity", self.intensityCharacteristic),
+            ("targetTime", self.targetTimeCharacteristic),
+            ("isTherapyActive", self.statusCharacteristic),
+            ("timeStamp", self.timeStampCharacteristic),
+            ("userId", self.userIdCharacteristic),
+        )
+        self.watch(self.publishState)
+
+    def setIsolation(self, arbitration):
+        """
+        Keep session state per central. Under "first" a session start is
+        refused with NotPermitted while another central's session runs,
+        under "latest" it ends that session and takes the actuator over.
+        """
+        if arbitration not in ARBITRATION_POLICIES:
+            raise ValueError("unknown arbitration policy %r" % arbitration)
+
+        self.arbitration = arbitration
+        ConnectionTracker.watch(self.onCentralGone)
+
+    def centralOf(self, options):
+        """Key of the caller's view, None for the actuator's own state"""
+        if self.arbitration is None or options.get("device") is None:
+            return None
+        return str(options["device"])
+
+    def snapshot(self, central=None):
+        if central is None or central == self.owner:
+            return self.state
+        return self.views.get(central, self.idle)
+
+    def update(self, central=None, **changes):
+        """Swap in a new snapshot with changes applied and return it"""
+        if central is not None and central != self.owner:
+            return self.updateView(central, **changes)
+
+        old = self.state
+        state = self.state = old._replace(version=old.version + 1, **changes)
+
+        for field, characteristic in self.stateCharacteristics:
+            if getattr(state, field) != getattr(old, field):
+                characteristic.set_value(getattr(state, field))
+
+        with self.changed:
+            self.changed.notify_all()
+        for watcher in list(self.watchers):
+            watcher(old, state)
+
+        return state
+
+    def updateView(self, central, **changes):
+        old = self.views.get(central, self.idle)
+        state = old._replace(version=old.version + 1, **changes)
+        if not state.isTherapyActive or old.isTherapyActive:
+            self.views[central] = state
+            return state
+
+        # Starting a session needs the actuator
+        if self.state.isTherapyActive:
+            if self.arbitration == "first":
+                raise NotPermittedException()
+
+            SessionLog.state(self, "session_preempted", self.owner or "")
+            self.update(intensity=0, targetTime=0, isTherapyActive=False)
+
+        if self.owner is not None and not self.ownerGone:
+            self.views[self.owner] = self.state
+        self.views.pop(central, None)
+        self.owner = central
+        self.ownerGone = False
+
+        fields = state._asdict()
+        del fields["version"]
+        return self.update(**fields)
+
+    def onCentralGone(self, central):
+        self.views.pop(central.path, None)
+        if central.path == self.owner:
+            # A running session keeps the actuator until it ends
+            if self.state.isTherapyActive:
+                self.ownerGone = True
+            else:
+                self.owner = None
+
+    def readView(self, characteristic, field, options):
+        """ReadValue reply of characteristic from the caller's view of field"""
+        central = self.centralOf(options)
+        if central is None or central == self.owner:
+            return characteristic.read_value(options)
+
+        value = getattr(self.snapshot(central), field)
+        return characteristic.read_value(options, characteristic.encode(value))
 
-    def __init__(self, index):
-        self.intensity = 0
-        self.elapsedTime = 0
-        self.startTime = 0
-        self.targetTime = 0
-        self.isTherapyActive = False
+    def watch(self, callback):
+        """Call callback(old, new) on the main loop after every change"""
+        self.watchers.append(callback)
 
-        self.timeStamp = ''
-        self.userId = ''
+    def unwatch(self, callback):
+        self.watchers.remove(callback)
 
-        Service.__init__(self, index, self.THERAPY_SVC_UUID, True)
+    def waitForChange(self, version, timeout=None):
+        """Block until the state is past version, return the latest snapshot"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.state.version != version, timeout)
+        return self.state
 
-        # Initialise Characteristics
-        self.add_characteristic(TimeCharacteristic(self))
-        self.add_characteristic(IntensityCharacteristic(self))
-        self.add_characteristic(TargetTimeCharacteristic(self))
-        self.add_characteristic(StatusCharacteristic(self))
-        self.add_characteristic(TimeStampCharacteristic(self))
-        self.add_characteristic(UserIdCharacteristic(self))
+    def publishState(self, old, state):
+        updateStatusUi(self.module, state.intensity, state.targetTime,
+                       state.userId, state.timeStamp)
 
     # Setters
     def setElapsedTime(self, elapsedTime):
-        self.elapsedTime = elapsedTime
+        self.update(elapsedTime=elapsedTime)
 
     def setStartTime(self, startTime):
-        self.startTime = startTime
-        
+        self.update(startTime=startTime)
+
     def setIntensity(self, intensity):
-        self.intensity = intensity
+        self.update(intensity=intensity)
 
     def setTargetTime(self, targetTime):
-        self.targetTime = targetTime
+        self.update(targetTime=targetTime)
 
     def setIsTherapyActive(self, isTherapyActive):
-        self.isTherapyActive = isTherapyActive
+        self.update(isTherapyActive=isTherapyActive)
 
-    def setTimeStamp(self, timeStamp):
-        self.timeStamp = timeStamp
-    
-    def setUserId(self, userId):
-        self.userId = userId
+    def setTimeStamp(self, timeStamp, central=None):
+        self.update(central, timeStamp=timeStamp)
+
+    def setUserId(self, userId, central=None):
+        self.update(central, userId=userId)
 
     # Getters
     def getElapsedTime(self):
-        return self.elapsedTime
-    
+        return self.state.elapsedTime
+
     def getStartTime(self):
-        return self.startTime
+        return self.state.startTime
 
     def getIntensity(self):
-        return self.intensity
-    
+        return self.state.intensity
+
     def getTargetTime(self):
-        return self.targetTime
-    
+        return self.state.targetTime
+
     def getIsTherapyActive(self):
-        return self.isTherapyActive
-    
+        return self.state.isTherapyActive
+
     def getTimeStamp(self):
-        return self.timeStamp
-    
+        return self.state.timeStamp
+
     def getUserId(self):
-        return self.userId
+        return self.state.userId
 
 # =============================================== TIME TRACKING CHARACTERISTIC ===============================================
 
-class TimeCharacteristic(Characteristic):
-    TIME_CHARACTERISTIC_UUID = "00000002-710e-4a5b-8d75-3e5b444bc3cf"
-
-    def __init__(self, service):
-        self.notifying = False
-        self.startTime = time.time()
+class TimeCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
         self.moduleTime = 0
+        self.therapyCheckJob = None
 
-        Characteristic.__init__(
-                self, self.TIME_CHARACTERISTIC_UUID,
-                ["notify", "read"], service)
-        self.add_descriptor(TimeDescriptor(self))
-
-        # Start the background reset thread
-        self.reset_thread = threading.Thread(target=self.reset_loop, daemon=True)
-        self.reset_thread.start()
-
-    def reset_loop(self):
-        while True:
-            time.sleep(1)
-
-            self.startTime = self.service.getStartTime()
-
-            elapsedTime = time.time() - self.startTime
-            targetTime = self.service.getTargetTime()
-
-            if (self.service.getIsTherapyActive()):
-                if targetTime > 0:
-                    # Update therapy progress UI
-                    updateTherapyUi(min(elapsedTime, targetTime), targetTime)
-                    updateStatusUi(
-                        self.service.getIntensity(),
-                        self.service.getTargetTime(),
-                        self.service.getUserId(),
-                        self.service.getTimeStamp()
-                    )
-                
-                # Check if therapy time is complete
-                if elapsedTime >= targetTime:
-                    #print(f"\n{bcolors.HEADER}[INFO] Therapy session completed after {targetTime}s{bcolors.ENDC}")
-                    showTherapyCompleted(targetTime)
-
-                    # Reset Other Characteristics
-                    self.service.setIntensity(0)
-                    self.service.setTargetTime(0)
-                    self.service.setIsTherapyActive(False)
-
-                    # Reset Local Vars
-                    self.moduleTime = 0
-                    self.startTime = time.time()
-                    #print(f"\n{bcolors.HEADER}[INFO] New Intensity: {self.service.getIntensity()} | New Target Time: {self.service.getTargetTime()}{bcolors.ENDC}")
-
-                    # Update UI to show inactive
-                    updateStatusUi(0, 0, 
-                                     self.service.getUserId(),
-                                     self.service.getTimeStamp())
-                    updateTherapyUi(0, 0)
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.set_value(self.moduleTime)
 
-    def getElapsedTime(self):
-        value = []
-        currentTime = time.time()
-
-        moduleTime = round(currentTime - self.startTime)
-
-        if (not self.service.getIsTherapyActive()):
-            moduleTime = 0
-            self.startTime = time.time()
-            self.service.setStartTime(self.startTime)
-            self.service.setElapsedTime(moduleTime)
-
-        self.service.setStartTime(self.startTime)
-        self.service.setElapsedTime(moduleTime)
-
-        # Convert to Byte String
-        strModuleTime = str(moduleTime)
-        for c in strModuleTime:
-            value.append(dbus.Byte(c.encode()))
-        return value
-
-    def setTimeElapsedCallback(self):
-        if self.notifying:
-            value = self.getElapsedTime()
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-        return self.notifying
-
-    def StartNotify(self):
-        if self.notifying:
-            return
+        # Only tick while a session runs, started and stopped by state changes
+        service.watch(self.onTherapyStateChanged)
 
-        self.notifying = True
+    def onTherapyStateChanged(self, old, state):
+        if state.isTherapyActive and self.therapyCheckJob is None:
+            self.therapyCheckJob = Scheduler.get_default().call_every(
+                    THERAPY_CHECK_INTERVAL, self.checkTherapy)
+        elif not state.isTherapyActive and self.therapyCheckJob is not None:
+            self.therapyCheckJob.cancel()
+            self.therapyCheckJob = None
 
-        value = self.getElapsedTime()
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-        self.add_timeout(NOTIFY_TIMEOUT, self.setTimeElapsedCallback)
+    def checkTherapy(self):
+        state = self.service.snapshot()
+        elapsedTime = Clock.get_default().now() - state.startTime
+        targetTime = state.targetTime
 
-    def StopNotify(self):
-        self.notifying = False
+        # Notifies subscribers only when the whole second changes
+        self.set_value(round(min(elapsedTime, targetTime)))
 
-    def ReadValue(self, options):
-        value = self.getElapsedTime()
-        return value
+        if targetTime > 0:
+            # Update therapy progress UI
+            updateTherapyUi(self.service.module, min(elapsedTime, targetTime), targetTime)
 
-class TimeDescriptor(Descriptor):
-    TIME_DESCRIPTOR_UUID = "2901"
-    TIME_DESCRIPTOR_VALUE = "Time Elapsed (Seconds)"
+        # Check if therapy time is complete
+        if elapsedTime >= targetTime:
+            #print(f"\n{bcolors.HEADER}[INFO] Therapy session completed after {targetTime}s{bcolors.ENDC}")
+            showTherapyCompleted(self.service.module, targetTime)
+            SessionLog.state(self.service, "session_complete")
+            Metrics.event("session_complete", module=self.service.module.name,
+                          userId=state.userId, targetTime=targetTime)
 
-    def __init__(self, characteristic):
-        Descriptor.__init__(
-                self, self.TIME_DESCRIPTOR_UUID,
-                ["read"],
-                characteristic)
+            # The final elapsed time goes out before the reset replaces it
+            self.notify_now()
 
-    def ReadValue(self, options):
-        value = []
-        desc = self.TIME_DESCRIPTOR_VALUE
+            # Reset the session in one step, which also stops this job
+            self.service.update(intensity=0, targetTime=0, isTherapyActive=False)
 
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
+            self.moduleTime = 0
+            self.set_value(self.moduleTime)
+            updateTherapyUi(self.service.module, 0, 0)
 
-        return value
+    def getElapsedTime(self, central=None):
+        state = self.service.snapshot(central)
 
-# =============================================== INTENSITY CHARACTERISTIC ===============================================
+        moduleTime = 0
+        if state.isTherapyActive:
+            moduleTime = round(Clock.get_default().now() - state.startTime)
 
-class IntensityCharacteristic(Characteristic):
-    UNIT_CHARACTERISTIC_UUID = "00000003-710e-4a5b-8d75-3e5b444bc3cf"
+        return self.encode(moduleTime)
 
-    def __init__(self, service):
-        self.notifying = False
+    @timed("read")
+    def ReadValue(self, options):
+        return self.read_value(options, self.getElapsedTime(self.service.centralOf(options)))
 
-        Characteristic.__init__(
-                self, self.UNIT_CHARACTERISTIC_UUID,
-                ["read", "write"], service)
-        self.add_descriptor(IntensityDescriptor(self))
+# =============================================== INTENSITY CHARACTERISTIC ===============================================
 
-    def getIntensity(self):
-        value = []
-        strValue = str(self.service.getIntensity())
-        for c in strValue:
-            value.append(dbus.Byte(c.encode()))
-        return value
+class IntensityCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.set_value(service.getIntensity())
 
+    @timed("read")
     def ReadValue(self, options):
-        value = self.getIntensity()
-        return value
+        return self.service.readView(self, "intensity", options)
     
+    @timed("write")
     def WriteValue(self, value, options):
+        value = self.assemble_write(value, options)
+        if value is None:
+            return
+        SessionLog.write(self, value, options)
         try:
-            strValue = ''.join([chr(byte) for byte in value])
-            newIntensity = int(strValue)
-
-            self.service.setIntensity(newIntensity)  # Update in parent service
-            updateStatusUi(
-                self.service.getIntensity(),
-                self.service.getTargetTime(),
-                self.service.getUserId(),
-                self.service.getTimeStamp()
-            )
+            newIntensity = self.decode(value)
 
             # Check to make sure Therapy doesn't start prematurely
-            if (self.service.getTargetTime() > 0):
-                self.service.setIsTherapyActive(True)
-                self.service.setElapsedTime(0)
-                self.service.setStartTime(time.time())
+            central = self.service.centralOf(options)
+            changes = {"intensity": newIntensity}
+            if (self.service.snapshot(central).targetTime > 0):
+                changes.update(isTherapyActive=True, elapsedTime=0,
+                               startTime=Clock.get_default().now())
+
+            state = self.service.update(central, **changes)  # Update in parent service
+            if "isTherapyActive" in changes:
+                SessionLog.state(self.service, "session_start", str(options.get("device", "")))
+                Metrics.event("session_start", module=self.service.module.name,
+                              userId=state.userId,
+                              intensity=state.intensity,
+                              targetTime=state.targetTime)
 
                 # print(f"{bcolors.OKGREEN}[INFO] Therapy Started{bcolors.ENDC}")
-                # print(f"User: {self.service.getUserId()}\tTime Stamp: {self.service.getTimeStamp()}")
-                showTherapyStarted()
-                statusWindow.addstr(1, 50, "Status: ACTIVE")
-                statusWindow.refresh()
+                # print(f"User: {state.userId}\tTime Stamp: {state.timeStamp}")
+                showTherapyStarted(self.service.module, state.userId, state.timeStamp)
             else:
                 # print(f"{bcolors.WARNING}[INFO] Awaiting Therapy Target Time{bcolors.ENDC}")
-                statusWindow.addstr(1, 50, "Status: WAITING")
-                statusWindow.refresh()
-
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": self.ReadValue({})}, [])
+                showStatusText(self.service.module, "WAITING")
 
             # print(f"[INFO] Intensity updated to: {self.service.getIntensity()}")
 
+        except NotPermittedException as e:
+            # Another central's session holds the actuator, tell the caller
+            showError(self.service.module, e)
+            raise
         except Exception as e:
-            statusWindow.addstr(3, 40, f"Error: {str(e)}")
-            statusWindow.refresh()
-
-class IntensityDescriptor(Descriptor):
-    INTENSITY_DESCRIPTOR_UUID = "2901"
-    INTENSITY_DESCRIPTOR_VALUE = "Intensity (%)"
-
-    def __init__(self, characteristic):
-        Descriptor.__init__(
-                self, self.INTENSITY_DESCRIPTOR_UUID,
-                ["read"],
-                characteristic)
-
-    def ReadValue(self, options):
-        value = []
-        desc = self.INTENSITY_DESCRIPTOR_VALUE
-
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-
-        return value
+            showError(self.service.module, e)
 
 # =============================================== TARGET TIME CHARACTERISTIC ===============================================
 
-class TargetTimeCharacteristic(Characteristic):
-    UNIT_CHARACTERISTIC_UUID = "00000004-710e-4a5b-8d75-3e5b444bc3cf"
-
-    def __init__(self, service):
-        self.notifying = False
-
-        Characteristic.__init__(
-                self, self.UNIT_CHARACTERISTIC_UUID,
-                ["read", "write"], service)
-        self.add_descriptor(TargetTimeDescriptor(self))
-
-    def getTargetTime(self):
-        value = []
-        strValue = str(self.service.getTargetTime())
-        for c in strValue:
-            value.append(dbus.Byte(c.encode()))
-        return value
+class TargetTimeCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.set_value(service.getTargetTime())
 
+    @timed("read")
     def ReadValue(self, options):
-        value = self.getTargetTime()
-        return value
+        return self.service.readView(self, "targetTime", options)
     
+    @timed("write")
     def WriteValue(self, value, options):
+        value = self.assemble_write(value, options)
+        if value is None:
+            return
+        SessionLog.write(self, value, options)
         try:
-            strValue = ''.join([chr(byte) for byte in value])
-            newTargetTime = int(strValue)
-
-            self.service.setTargetTime(newTargetTime)  # Update in parent service
-            updateStatusUi(
-                self.service.getIntensity(),
-                self.service.getTargetTime(),
-                self.service.getUserId(),
-                self.service.getTimeStamp()
-            )
+            newTargetTime = self.decode(value)
 
             # Check to make sure Therapy doesn't start prematurely
-            if (self.service.getIntensity() > 0):
-                self.service.setIsTherapyActive(True)
-                self.service.setElapsedTime(0)
-                self.service.setStartTime(time.time())
-
-                showTherapyStarted()
-                statusWindow.addstr(1, 50, "Status: ACTIVE")
-                statusWindow.refresh()
+            central = self.service.centralOf(options)
+            changes = {"targetTime": newTargetTime}
+            if (self.service.snapshot(central).intensity > 0):
+                changes.update(isTherapyActive=True, elapsedTime=0,
+                               startTime=Clock.get_default().now())
+
+            state = self.service.update(central, **changes)  # Update in parent service
+            if "isTherapyActive" in changes:
+                SessionLog.state(self.service, "session_start", str(options.get("device", "")))
+                Metrics.event("session_start", module=self.service.module.name,
+                              userId=state.userId,
+                              intensity=state.intensity,
+                              targetTime=state.targetTime)
+
+                showTherapyStarted(self.service.module, state.userId, state.timeStamp)
                 # print(f"{bcolors.OKGREEN}[INFO] Therapy Started{bcolors.ENDC}")
-                # print(f"User: {self.service.getUserId()}\tTime Stamp: {self.service.getTimeStamp()}")
+                # print(f"User: {state.userId}\tTime Stamp: {state.timeStamp}")
             else:
-                statusWindow.addstr(1, 50, "Status: WAITING")
-                statusWindow.refresh()
+                showStatusText(self.service.module, "WAITING")
                 # print(f"{bcolors.WARNING}[INFO] Awaiting Therapy Intensity{bcolors.ENDC}")
 
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": self.ReadValue({})}, [])
-
             #print(f"[INFO] Target Time updated to: {self.service.getTargetTime()}")
 
+        except NotPermittedException as e:
+            showError(self.service.module, e)
+            raise
         except Exception as e:
-            statusWindow.addstr(3, 40, f"Error: {str(e)}")
-            statusWindow.refresh()
+            showError(self.service.module, e)
             #print(f"[ERROR] Failed to write Target Time value: {e}")
 
-class TargetTimeDescriptor(Descriptor):
-    TARGET_TIME_DESCRIPTOR_UUID = "2901"
-    TARGET_TIME_DESCRIPTOR_VALUE = "Target Time (Seconds)"
-
-    def __init__(self, characteristic):
-        Descriptor.__init__(
-                self, self.TARGET_TIME_DESCRIPTOR_UUID,
-                ["read"],
-                characteristic)
-
-    def ReadValue(self, options):
-        value = []
-        desc = self.TARGET_TIME_DESCRIPTOR_VALUE
-
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-
-        return value
-    
 # =============================================== STATUS CHARACTERISTIC ===============================================
 
-class StatusCharacteristic(Characteristic):
-    UNIT_CHARACTERISTIC_UUID = "00000005-710e-4a5b-8d75-3e5b444bc3cf"
-
-    def __init__(self, service):
-        self.notifying = False
+class StatusCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
         self.status = ""
 
-        Characteristic.__init__(
-                self, self.UNIT_CHARACTERISTIC_UUID,
-                ["notify", "read"], service)
-        self.add_descriptor(TargetTimeDescriptor(self))
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.set_value(service.getIsTherapyActive())
 
     def getStatus(self):
-        value = []
-        
-        self.status = "Inactive"
-        if (self.service.getIsTherapyActive()):
-            self.status = "Active"
-
-        strValue = self.status
-        for c in strValue:
-            value.append(dbus.Byte(c.encode()))
-        return value
-
-    def setTargetTimeCallback(self):
-        if self.notifying:
-
-            value = self.getStatus()
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-
-        return self.notifying
-
-    def StartNotify(self):
-        if self.notifying:
-            return
-
-        self.notifying = True
-
-        value = self.getStatus()
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-        self.add_timeout(NOTIFY_TIMEOUT, self.setTargetTimeCallback)
-
-    def StopNotify(self):
-        self.notifying = False
+        return self.get_value()
 
+    @timed("read")
     def ReadValue(self, options):
-        value = self.getStatus()
-        return value
+        return self.service.readView(self, "isTherapyActive", options)
     
 # =============================================== TIME STAMP CHARACTERISTIC ===============================================
 
-class TimeStampCharacteristic(Characteristic):
-    TIME_STAMP_CHARACTERISTIC_UUID = "00000006-710e-4a5b-8d75-3e5b444bc3cf"
-
-    def __init__(self, service):
+class TimeStampCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
         self.timeStamp = ""
-        Characteristic.__init__(
-                self, self.TIME_STAMP_CHARACTERISTIC_UUID,
-                ["write"], service)
-        self.add_descriptor(TimeStampDescriptor(self))
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.set_value(self.timeStamp)
 
+    @timed("write")
     def WriteValue(self, value, options):
+        value = self.assemble_write(value, options)
+        if value is None:
+            return
+        SessionLog.write(self, value, options)
         try:
-            self.timeStamp = ''.join([chr(byte) for byte in value])
+            self.timeStamp = self.decode(value)
             #print(f"{bcolors.OKGREEN}[TIMESTAMP] {self.timeStamp}{bcolors.ENDC}")
 
-            self.service.setTimeStamp(self.timeStamp)
-            updateStatusUi(
-                self.service.getIntensity(),
-                self.service.getTargetTime(),
-                self.service.getUserId(),
-                self.service.getTimeStamp()
-            )
+            self.service.setTimeStamp(self.timeStamp, self.service.centralOf(options))
         except Exception as e:
             # print(f"[ERROR] Failed to write Timestamp: {e}")
-            statusWindow.addstr(3, 40, f"Error: {str(e)}")
-            statusWindow.refresh()
+            showError(self.service.module, e)
 
+    @timed("read")
     def ReadValue(self, options):
-        value = []
-        for c in self.timeStamp:
-            value.append(dbus.Byte(c.encode()))
-        return value
+        return self.service.readView(self, "timeStamp", options)
 
-class TimeStampDescriptor(Descriptor):
-    TIME_STAMP_DESCRIPTOR_UUID = "2901"
-    TIME_STAMP_DESCRIPTOR_VALUE = "Timestamp (DD:MM:YYYYTHH:MM:SS)"
-
-    def __init__(self, characteristic):
-        Descriptor.__init__(
-                self, self.TIME_STAMP_DESCRIPTOR_UUID,
-                ["read"],
-                characteristic)
-
-    def ReadValue(self, options):
-        value = []
-        desc = self.TIME_STAMP_DESCRIPTOR_VALUE
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-        return value
-    
 # =============================================== USER ID CHARACTERISTIC ===============================================
 
-class UserIdCharacteristic(Characteristic):
-    USER_ID_CHARACTERISTIC_UUID = "00000007-710e-4a5b-8d75-3e5b444bc3cf"
-
-    def __init__(self, service):
+class UserIdCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
         self.userId = ""
-        Characteristic.__init__(
-                self, self.USER_ID_CHARACTERISTIC_UUID,
-                ["write"], service)
-        self.add_descriptor(UserIdDescriptor(self))
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.set_value(self.userId)
 
+    @timed("write")
     def WriteValue(self, value, options):
+        value = self.assemble_write(value, options)
+        if value is None:
+            return
+        SessionLog.write(self, value, options)
         try:
-            self.userId = ''.join([chr(byte) for byte in value])
+            self.userId = self.decode(value)
             # print(f"{bcolors.OKGREEN}[USER ID] {self.userId}{bcolors.ENDC}")
-            updateStatusUi(
-                self.service.getIntensity(),
-                self.service.getTargetTime(),
-                self.service.getUserId(),
-                self.service.getTimeStamp()
-            )
-
-            self.service.setUserId(self.userId)
+            self.service.setUserId(self.userId, self.service.centralOf(options))
         except Exception as e:
             # print(f"[ERROR] Failed to write User ID: {e}")
-            statusWindow.addstr(3, 40, f"Error: {str(e)}")
-            statusWindow.refresh()
+            showError(self.service.module, e)
 
+    @timed("read")
     def ReadValue(self, options):
-        value = []
-        for c in self.userId:
-            value.append(dbus.Byte(c.encode()))
-        return value
+        return self.service.readView(self, "userId", options)
+
+# ===============================================================================================================
+# =============================================== HISTORY SERVICE ===============================================
+# ===============================================================================================================
+
+class HistoryService(ProfileService):
+    """
+    Completed sessions in a ring buffer, downloaded as one notification stream.
+
+    Values are little endian binary in every wire format. A record is
+        <B length of the rest> <I seq> <I completed, unix s> <B intensity>
+        <H target s> <H duration s> <B n> userId <B n> timeStamp
+    Control point commands:
+        0x01 START <I from seq> <H credits>   stream records from seq on
+        0x02 CREDIT <H credits>               allow that many more packets
+        0x03 STOP
+    Each data notification is <H packet seq> <B flags> followed by the next
+    bytes of the record stream, MTU - 3 bytes in total, and uses one credit.
+    FLAG_CAUGHT_UP marks the packet that ends the stored history; sessions
+    completed later keep streaming while credits remain. Resuming from a seq
+    that has been overwritten starts at the oldest record still stored.
+    """
+    RECORD = struct.Struct("<IIBHH")
+
+    def __init__(self, index, module, entry, path_base=None):
+        self.records = collections.deque(maxlen=HISTORY_CAPACITY)
+        self.nextSeq = 0
+
+        ProfileService.__init__(self, index, module, entry, path_base)
+
+        self.dataCharacteristic = self.characteristic("historyData")
+        self.controlCharacteristic = self.characteristic("historyControl")
+        self.infoCharacteristic = self.characteristic("historyInfo")
+
+        module.service("therapy").watch(self.onTherapyStateChanged)
+
+    def onTherapyStateChanged(self, old, state):
+        if old.isTherapyActive and not state.isTherapyActive:
+            elapsed = round(Clock.get_default().now() - old.startTime)
+            self.addSession(old.userId, old.timeStamp, old.intensity,
+                            old.targetTime, min(elapsed, old.targetTime))
+
+    def addSession(self, userId, timeStamp, intensity, targetTime, duration):
+        userId = userId.encode()[:255]
+        timeStamp = timeStamp.encode()[:255]
+        stamp = int(Clock.get_default().wall_time())
+        body = self.RECORD.pack(self.nextSeq, stamp, intensity, targetTime, duration) \
+                + bytes([len(userId)]) + userId + bytes([len(timeStamp)]) + timeStamp
+
+        # Serialised once, every download shares the same bytes
+        self.records.append((self.nextSeq, bytes([len(body)]) + body))
+        self.nextSeq += 1
+
+        self.infoCharacteristic.refresh()
+        self.dataCharacteristic.onRecordAdded()
+
+    def firstSeq(self):
+        return self.records[0][0] if self.records else self.nextSeq
+
+    def getRecord(self, seq):
+        """(seq, bytes) of the oldest stored record at or after seq, or None"""
+        if seq >= self.nextSeq or not self.records:
+            return None
+
+        first = self.firstSeq()
+        return self.records[max(0, seq - first)]
+
+class HistoryDataCharacteristic(ProfileCharacteristic):
+    PACKET = struct.Struct("<HB")
+    FLAG_CAUGHT_UP = 0x01
+
+    def __init__(self, service, entry):
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.streaming = False
+        self.credits = 0
+        self.nextRecord = 0
+        self.packetSeq = 0
+        self.pending = bytearray()
+        self.payloadSize = DEFAULT_MTU - NOTIFY_OVERHEAD - self.PACKET.size
+        self.pumpJob = None
+
+    def start(self, fromSeq, credits, mtu):
+        self.streaming = True
+        self.credits = credits
+        self.nextRecord = fromSeq
+        self.packetSeq = 0
+        self.pending = bytearray()
+        self.payloadSize = max(1, mtu - NOTIFY_OVERHEAD - self.PACKET.size)
+        self.schedulePump()
+
+    def grant(self, credits):
+        self.credits += credits
+        self.schedulePump()
+
+    def stop(self):
+        self.streaming = False
+        self.pending = bytearray()
+        if self.pumpJob is not None:
+            self.pumpJob.cancel()
+            self.pumpJob = None
+
+    def onRecordAdded(self):
+        if self.streaming:
+            self.schedulePump()
+
+    def schedulePump(self):
+        if self.pumpJob is None:
+            self.pumpJob = Scheduler.get_default().call_later(0, self.pump)
+
+    def fill(self):
+        # Serialise only as many records as the next packet needs
+        while len(self.pending) < self.payloadSize:
+            record = self.service.getRecord(self.nextRecord)
+            if record is None:
+                return
+
+            seq, data = record
+            self.pending += data
+            self.nextRecord = seq + 1
+
+    def pump(self):
+        self.pumpJob = None
+
+        sent = 0
+        while self.streaming and self.notifying and self.credits > 0:
+            if sent == HISTORY_BATCH:
+                # Give the rest of the main loop a turn before going on
+                self.schedulePump()
+                return
+
+            self.fill()
+            if not self.pending:
+                return
+
+            chunk = bytes(self.pending[:self.payloadSize])
+            del self.pending[:self.payloadSize]
+
+            flags = 0
+            if not self.pending and self.service.getRecord(self.nextRecord) is None:
+                flags |= self.FLAG_CAUGHT_UP
+
+            # Sent straight away, coalescing would drop packets
+            self.send_notification(encode_value(
+                self.PACKET.pack(self.packetSeq & 0xFFFF, flags) + chunk))
+            self.packetSeq += 1
+            self.credits -= 1
+            sent += 1
+
+    def StopNotify(self):
+        ProfileCharacteristic.StopNotify(self)
+        self.stop()
+
+class HistoryControlCharacteristic(ProfileCharacteristic):
+    OP_START = 0x01
+    OP_CREDIT = 0x02
+    OP_STOP = 0x03
 
-class UserIdDescriptor(Descriptor):
-    USER_ID_DESCRIPTOR_UUID = "2901"
-    USER_ID_DESCRIPTOR_VALUE = "User ID"
+    START = struct.Struct("<BIH")
+    CREDIT = struct.Struct("<BH")
 
-    def __init__(self, characteristic):
+    @timed("write")
+    def WriteValue(self, value, options):
+        value = self.assemble_write(value, options)
+        if value is None:
+            return
+        value = bytes(value)
+        SessionLog.write(self, value, options)
+        stream = self.service.dataCharacteristic
+
+        if not value:
+            raise InvalidValueLengthException()
+
+        opcode = value[0]
+        if opcode == self.OP_START:
+            if len(value) != self.START.size:
+                raise InvalidValueLengthException()
+            _, fromSeq, credits = self.START.unpack(value)
+            stream.start(fromSeq, credits, int(options.get("mtu", DEFAULT_MTU)))
+        elif opcode == self.OP_CREDIT:
+            if len(value) != self.CREDIT.size:
+                raise InvalidValueLengthException()
+            stream.grant(self.CREDIT.unpack(value)[1])
+        elif opcode == self.OP_STOP:
+            stream.stop()
+        else:
+            raise NotSupportedException()
+
+class HistoryInfoCharacteristic(ProfileCharacteristic):
+    # Oldest stored seq, next seq to be assigned, capacity
+    INFO = struct.Struct("<IIH")
+
+    def __init__(self, service, entry):
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.refresh()
+
+    def refresh(self):
+        self.set_value(self.INFO.pack(self.service.firstSeq(), self.service.nextSeq,
+                                      HISTORY_CAPACITY))
+
+    @timed("read")
+    def ReadValue(self, options):
+        return self.read_value(options)
+
+# ===============================================================================================================
+# =============================================== SENSOR SERVICE ================================================
+# ===============================================================================================================
+
+class SensorModel(object):
+    """
+    The quantity a module type measures, generated a block at a time.
+    generate(t, intensity) returns float samples for the times in t, given
+    in seconds, and keeps whatever state the next block continues from.
+    Samples are sent as int16 after multiplying by scale.
+    """
+    unit = ""
+    scale = 1
+
+    def __init__(self, seed):
+        self.rng = numpy.random.default_rng(seed)
+        self.last = None
+
+    def generate(self, t, intensity):
+        raise NotImplementedError()
+
+    def elapsed(self, t):
+        """Seconds from the end of the previous block to each time in t"""
+        last = t[0] if self.last is None else self.last
+        self.last = t[-1]
+        return t - last
+
+class TemperatureModel(SensorModel):
+    """Skin temperature under a heat pad, a first order lag towards intensity"""
+    unit = "0.01 C"
+    scale = 100
+
+    AMBIENT = 32.0
+    MAX_RISE = 10.0
+    TIME_CONSTANT = 30.0
+    NOISE = 0.02
+
+    def __init__(self, seed):
+        SensorModel.__init__(self, seed)
+        self.temperature = self.AMBIENT
+
+    def generate(self, t, intensity):
+        target = self.AMBIENT + self.MAX_RISE * intensity / 100.0
+        curve = target + (self.temperature - target) * numpy.exp(-self.elapsed(t) / self.TIME_CONSTANT)
+        self.temperature = curve[-1]
+        return curve + self.rng.normal(0, self.NOISE, len(t))
+
+class VibrationModel(SensorModel):
+    """Acceleration of a vibration motor whose speed and amplitude follow intensity"""
+    unit = "mg"
+
+    MIN_FREQUENCY = 30.0
+    MAX_FREQUENCY = 150.0
+    MAX_AMPLITUDE = 800.0
+    NOISE = 15.0
+
+    def __init__(self, seed):
+        SensorModel.__init__(self, seed)
+        self.phase = 0.0
+
+    def generate(self, t, intensity):
+        frequency = self.MIN_FREQUENCY + (self.MAX_FREQUENCY - self.MIN_FREQUENCY) * intensity / 100.0
+        phase = self.phase + 2 * numpy.pi * frequency * self.elapsed(t)
+        self.phase = phase[-1] % (2 * numpy.pi)
+
+        amplitude = self.MAX_AMPLITUDE * intensity / 100.0
+        return amplitude * numpy.sin(phase) + self.rng.normal(0, self.NOISE, len(t))
+
+class IrPowerModel(SensorModel):
+    """Optical power of an IR LED array with driver ripple"""
+    unit = "0.1 mW"
+    scale = 10
+
+    MAX_POWER = 500.0
+    RIPPLE = 0.03
+    RIPPLE_FREQUENCY = 100.0
+    NOISE = 0.01
+
+    def generate(self, t, intensity):
+        self.elapsed(t)
+        power = self.MAX_POWER * intensity / 100.0
+        ripple = self.RIPPLE * numpy.sin(2 * numpy.pi * self.RIPPLE_FREQUENCY * t)
+        return power * (1 + ripple + self.rng.normal(0, self.NOISE, len(t)))
+
+SENSOR_MODELS = {
+    "TMP-VIR": TemperatureModel,
+    "VBR-VIR": VibrationModel,
+    "IR-VIR": IrPowerModel,
+}
+
+class SensorService(ProfileService):
+    """
+    A live reading from the module's actuator, shaped by the session intensity.
+
+    Values are little endian binary in every wire format. Each data
+    notification is <I index of the first sample> followed by as many int16
+    samples as fit in the notification MTU. The rate characteristic holds the
+    sample rate in Hz, SENSOR_MIN_RATE to SENSOR_MAX_RATE, and the unit
+    descriptor names what a sample counts. Samples are generated while a
+    central is subscribed; an index gap means samples were dropped because
+    notifications fell behind.
+    """
+    def __init__(self, index, module, entry, path_base=None):
+        if numpy is None:
+            raise RuntimeError("The sensor stream needs numpy")
+
+        self.model = SENSOR_MODELS[module.deviceId](module.index)
+        ProfileService.__init__(self, index, module, entry, path_base)
+
+        self.dataCharacteristic = self.characteristic("sensorData")
+        self.rateCharacteristic = self.characteristic("sensorRate")
+
+    def getIntensity(self):
+        state = self.module.service("therapy").snapshot()
+        return state.intensity if state.isTherapyActive else 0
+
+class SensorDataCharacteristic(ProfileCharacteristic):
+    HEADER = struct.Struct("<I")
+    SAMPLE = "<i2"
+    SAMPLE_SIZE = 2
+
+    def __init__(self, service, entry):
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.add_descriptor(SensorUnitDescriptor(self, service.model.unit))
+
+        self.rate = SENSOR_MIN_RATE
+        self.ring = numpy.zeros(SENSOR_BUFFER_SIZE, dtype=self.SAMPLE)
+        self.generated = 0
+        self.sent = 0
+        self.origin = 0
+        self.tickJob = None
+
+    def setRate(self, rate):
+        # Restart the sample clock so indices stay continuous at the new rate
+        self.origin = Scheduler.get_default().now() - self.generated / float(rate)
+        self.rate = rate
+
+    def start_notifying(self):
+        ProfileCharacteristic.start_notifying(self)
+        if self.tickJob is None:
+            self.origin = Scheduler.get_default().now() - self.generated / float(self.rate)
+            self.tickJob = Scheduler.get_default().call_every(SENSOR_TICK_INTERVAL, self.tick)
+
+    def StopNotify(self):
+        ProfileCharacteristic.StopNotify(self)
+        if self.tickJob is not None:
+            self.tickJob.cancel()
+            self.tickJob = None
+
+    def tick(self):
+        due = int((Scheduler.get_default().now() - self.origin) * self.rate)
+        if due > self.generated:
+            self.generate(due - self.generated)
+        self.pump()
+
+    def generate(self, count):
+        # Anything older than the ring is gone, generate only what it holds
+        skipped = max(0, count - SENSOR_BUFFER_SIZE)
+        first = self.generated + skipped
+        count -= skipped
+
+        t = self.origin + (first + numpy.arange(count)) / float(self.rate)
+        samples = self.service.model.generate(t, self.service.getIntensity())
+        samples = numpy.clip(numpy.rint(samples * self.service.model.scale), -32768, 32767)
+
+        positions = (first + numpy.arange(count)) % SENSOR_BUFFER_SIZE
+        self.ring[positions] = samples
+        self.generated = first + count
+        self.sent = max(self.sent, self.generated - SENSOR_BUFFER_SIZE)
+
+    def pump(self):
+        perPacket = (self.notify_mtu - NOTIFY_OVERHEAD - self.HEADER.size) // self.SAMPLE_SIZE
+
+        # Only whole packets, the rest waits for the next block
+        while self.notifying and self.generated - self.sent >= perPacket:
+            positions = numpy.arange(self.sent, self.sent + perPacket) % SENSOR_BUFFER_SIZE
+            packet = self.HEADER.pack(self.sent & 0xFFFFFFFF) + self.ring[positions].tobytes()
+            self.send_notification(encode_value(packet))
+            self.sent += perPacket
+
+class SensorUnitDescriptor(Descriptor):
+    SENSOR_UNIT_DESCRIPTOR_UUID = "2901"
+
+    def __init__(self, characteristic, unit):
         Descriptor.__init__(
-                self, self.USER_ID_DESCRIPTOR_UUID,
+                self, self.SENSOR_UNIT_DESCRIPTOR_UUID,
                 ["read"],
                 characteristic)
+        self.set_value(f"Samples ({unit})")
+
+class SensorRateCharacteristic(ProfileCharacteristic):
+    def __init__(self, service, entry):
+        ProfileCharacteristic.__init__(self, service, entry)
+        self.setRate(service.module.sensorRate)
+
+    def setRate(self, rate):
+        if not SENSOR_MIN_RATE <= rate <= SENSOR_MAX_RATE:
+            raise InvalidArgsException()
+
+        self.service.characteristic("sensorData").setRate(rate)
+        self.set_value(rate)
+
+    @timed("write")
+    def WriteValue(self, value, options):
+        value = self.assemble_write(value, options)
+        if value is None:
+            return
+        SessionLog.write(self, value, options)
+        self.setRate(self.decode(value))
 
+    @timed("read")
     def ReadValue(self, options):
-        value = []
-        desc = self.USER_ID_DESCRIPTOR_VALUE
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-        return value
-    
-# =============================================== MAIN CODE ===============================================
-def main(stdscr):
-    initUi()
-    
-    app = Application()
-    app.add_service(TherapyService(0))
-    app.add_service(InfoService(1))
-    app.register()
+        return self.read_value(options)
+
+# ===============================================================================================================
+# =============================================== VIRTUAL MODULE ================================================
+# ===============================================================================================================
 
-    adv = TherapyAdvertisement(0)
-    adv.register()
+# Behaviour models profiles refer to by name
+for model, cls in (
+        ("therapy", TherapyService), ("time", TimeCharacteristic),
+        ("intensity", IntensityCharacteristic), ("targetTime", TargetTimeCharacteristic),
+        ("status", StatusCharacteristic), ("timeStamp", TimeStampCharacteristic),
+        ("userId", UserIdCharacteristic),
+        ("info", InfoService), ("deviceId", DeviceIdCharacteristic),
+        ("location", LocationIdCharacteristic), ("battery", BatteryLifeCharacteristic),
+        ("firmwareVersion", FirmwareVersionCharacteristic),
+        ("history", HistoryService), ("historyData", HistoryDataCharacteristic),
+        ("historyControl", HistoryControlCharacteristic), ("historyInfo", HistoryInfoCharacteristic),
+        ("sensor", SensorService), ("sensorData", SensorDataCharacteristic),
+        ("sensorRate", SensorRateCharacteristic)):
+    register_model(model, cls)
+
+class VirtualModule(object):
+    """
+    One simulated module: its identity, GATT application and advertisement.
+
+    Everything but the index comes from a profile, see moduleprofile.py.
+    name and location override the profile's identity for fleet members.
+    """
+
+    def __init__(self, index, profile=DEFAULT_PROFILE, name=None, location=None, fleet=False,
+                 wireFormat=None, sensorRate=None, arbitration=None):
+        self.table = compile_profile(profile, wireFormat)
+        identity = self.table.identity
+
+        self.index = index
+        self.name = name if name is not None else identity["name"]
+        self.deviceId = identity["deviceId"]
+        self.location = location if location is not None else identity["location"]
+        self.firmwareVersion = identity["firmwareVersion"]
+        self.wireFormat = self.table.wireFormat
+        self.sensorRate = sensorRate
+
+        # A fleet module gets its own object manager and service namespace
+        if fleet:
+            self.path = MODULE_PATH_BASE + str(index)
+            servicePathBase = self.path + "/service"
+        else:
+            self.path = "/"
+            servicePathBase = None
+
+        self.app = Application(self.path)
+        self.services = {}
+        for entry in self.table.services:
+            # The sensor stream only runs when a rate was asked for
+            if entry.model == "sensor" and sensorRate is None:
+                continue
+
+            service = resolve_model(entry.model, ProfileService)(entry.index, self, entry,
+                                                                 servicePathBase)
+            self.services[entry.model] = service
+            self.app.add_service(service)
+
+        self.therapyService = self.services.get("therapy")
+        self.infoService = self.services.get("info")
+        self.historyService = self.services.get("history")
+        self.sensorService = self.services.get("sensor")
+
+        if arbitration is not None:
+            self.therapyService.setIsolation(arbitration)
+
+        self.advertisement = TherapyAdvertisement(index, self.name)
+
+    def service(self, model):
+        return self.services[model]
+
+    def register(self, advertiser=None):
+        """Register with BlueZ, advertising through advertiser if one is given"""
+        self.app.register()
+        if advertiser is not None:
+            advertiser.add(self.advertisement)
+        else:
+            self.advertisement.register()
+
+def createFleet(count, wireFormat=None, sensorRate=None, profiles=FLEET_PROFILES,
+                arbitration=None):
+    """Create count modules cycling through profiles"""
+    return [createFleetModule(index, wireFormat, sensorRate, profiles, arbitration)
+            for index in range(count)]
+
+def createFleetModule(index, wireFormat=None, sensorRate=None, profiles=FLEET_PROFILES,
+                      arbitration=None):
+    """The module createFleet puts at index"""
+    profile = profiles[index % len(profiles)]
+    return VirtualModule(
+        index,
+        profile,
+        name=f"{compile_profile(profile, wireFormat).identity['name']} {index}",
+        location=(index % 0xFF) + 1,
+        fleet=True,
+        wireFormat=wireFormat,
+        sensorRate=sensorRate,
+        arbitration=arbitration
+    )
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Virtual LM Health therapy module")
+    parser.add_argument("--fleet", type=int, default=0, metavar="N",
+                        help="host N virtual modules in this process")
+    parser.add_argument("--bus", default=BleTools.bus_address,
+                        help="system, session or a D-Bus address such as one from fakebluez.py")
+    parser.add_argument("--backend", choices=("glib", "asyncio"), default=BleTools.backend,
+                        help="serve D-Bus with dbus-python on GLib or dbus-next on asyncio")
+    parser.add_argument("--profile", action="append", metavar="PROFILE",
+                        help="module profile, a path or a file in profiles/; "
+                             "repeat to cycle a fleet through several")
+    parser.add_argument("--wire-format", choices=WIRE_FORMATS,
+                        help="encoding of characteristic values, by default the profile's")
+    parser.add_argument("--sensor-rate", type=int, metavar="HZ",
+                        help="stream simulated sensor readings at HZ samples per second "
+                             f"({SENSOR_MIN_RATE}-{SENSOR_MAX_RATE}), needs numpy")
+    parser.add_argument("--isolate", choices=ARBITRATION_POLICIES, metavar="POLICY",
+                        help="keep therapy state per central; POLICY first or latest "
+                             "decides which central's session drives the actuator")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without the curses UI")
+    parser.add_argument("--metrics", metavar="TARGET",
+                        help="write JSON line metrics to a file, unix:<socket> or - for stdout")
+    parser.add_argument("--metrics-interval", type=int, default=METRICS_INTERVAL, metavar="MS",
+                        help="milliseconds between aggregated stats lines")
+    parser.add_argument("--speed", type=float, default=1.0, metavar="FACTOR",
+                        help="run therapy sessions and battery drain FACTOR times faster")
+    parser.add_argument("--session-log", metavar="PATH",
+                        help="append writes, notifications and session transitions to a binary log")
+    parser.add_argument("--instrument", action="store_true",
+                        help="time every D-Bus handler, queryable over com.lmhealth.Debug1")
+    parser.add_argument("--slow-call-ms", type=float, default=50.0, metavar="MS",
+                        help="handlers slower than this go to the slow-call log")
+    parser.add_argument("--slow-call-log", metavar="PATH",
+                        help="also append slow calls as JSON lines to PATH")
+    args = parser.parse_args()
+
+    if args.sensor_rate is not None and not SENSOR_MIN_RATE <= args.sensor_rate <= SENSOR_MAX_RATE:
+        parser.error(f"--sensor-rate must be between {SENSOR_MIN_RATE} and {SENSOR_MAX_RATE}")
+    return args
+
+# =============================================== MAIN CODE ===============================================
+def registerAsyncio(loop, modules, bus):
+    # dbus-next is only needed for this backend
+    from aiobackend import AsyncioBackend
+
+    backend = AsyncioBackend(bus)
+    loop.run_until_complete(backend.connect())
+    for module in modules:
+        loop.run_until_complete(backend.register_application(module.app))
+        loop.run_until_complete(backend.register_advertisement(module.advertisement))
+    return backend
+
+def main(stdscr, args):
+    BleTools.set_bus_address(args.bus)
+    BleTools.set_backend(args.backend)
+    Clock.set_default(RealClock() if args.speed == 1 else ScaledClock(args.speed))
+
+    loop = None
+    if args.backend == "asyncio":
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        Scheduler.set_default(Scheduler(timers=AsyncioTimers(loop)))
+
+    if args.fleet > 0:
+        modules = createFleet(args.fleet, args.wire_format, args.sensor_rate,
+                              args.profile or FLEET_PROFILES, args.isolate)
+    else:
+        profile = args.profile[0] if args.profile else DEFAULT_PROFILE
+        modules = [VirtualModule(0, profile, wireFormat=args.wire_format,
+                                 sensorRate=args.sensor_rate, arbitration=args.isolate)]
+
+    if not args.headless:
+        initUi(modules[0])
+
+    if args.metrics:
+        sink = Metrics.open(args.metrics)
+        Scheduler.get_default().call_every(args.metrics_interval, sink.flush)
+
+    if args.session_log:
+        # Replay builds its modules from these
+        log = SessionLog.open(args.session_log, {
+            "fleet": args.fleet,
+            "profiles": args.profile,
+            "wireFormat": args.wire_format,
+            "sensorRate": args.sensor_rate,
+            "isolate": args.isolate,
+        })
+        Scheduler.get_default().call_every(SESSION_LOG_FLUSH_INTERVAL, log.flush)
+
+    if args.instrument:
+        Instrumentation.enable(args.slow_call_ms, args.slow_call_log)
 
     try:
-        #print(f"{bcolors.OKBLUE}Advertising as {VIRTUAL_DEVICE_NAME}...{bcolors.ENDC}")
-        app.run()
+        if loop is not None:
+            registerAsyncio(loop, modules, args.bus)
+            loop.run_forever()
+        else:
+            # One manager shares the controller's advertising slots across the fleet
+            advertiser = AdvertisementManager()
+            for module in modules:
+                module.register(advertiser)
+            advertiser.start()
+            modules[0].app.run()
     except KeyboardInterrupt:
-        app.quit()
+        if loop is None:
+            modules[0].app.quit()
         #print("Terminating Application")
     finally:
         closeUi()
+        if SessionLog.active is not None:
+            SessionLog.active.close()
 
 if __name__ == "__main__":
-    wrapper(main)
\ No newline at end of file
+    args = parseArgs()
+    if args.headless:
+        main(None, args)
+    else:
+        wrapper(main, args)
\ No newline at end of file